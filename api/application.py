@@ -1,9 +1,12 @@
+import os
+from threading import Lock
 from flask import Flask
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_smorest import Api
-from flask_migrate import Migrate
-from extensions import db
+from flask_migrate import Migrate, stamp, upgrade
+from sqlalchemy import inspect
+from extensions import db, result_cache, tile_coordinator
 from models import Task
 import logging
 
@@ -26,8 +29,24 @@ app.config.from_mapping(
     OPENAPI_SWAGGER_UI_URL="https://cdn.jsdelivr.net/npm/swagger-ui-dist/",
     ALLOWED_EXTENSIONS={"rar", "zip", "tgz", "tar.gz"},
     MAX_CONTENT_LENGTH=100 * 2**20,  # 100 MB
+    MAX_BATCH_ARCHIVES=50,  # сколько архивов можно отправить в одном пакете
+    BATCH_CACHE_MAX_BYTES=256 * 2**20,  # 256 MB под общий кэш отпечатков/документов пакета (отпечаток copydetect'а ~100 байт на байт кода), самые давно использованные вытесняются
     SQLALCHEMY_DATABASE_URI="sqlite:///tasksdb.db",
-    SQLALCHEMY_TRACK_MODIFICATIONS=False
+    SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    RESULT_CACHE_MAX_BYTES=64 * 2**20,  # 64 MB под закэшированные ответы по завершённым task'ам
+    TILES_DB="tiles.db",  # очередь тайлов copydetect'а с чекпоинтами (см. tiles.py), для нескольких машин - путь на общей папке (рядом с ней копируются архивы)
+    TILE_SIZE=64,  # сторона тайла в файлах, 0 - считать группы целиком без очереди
+    TILE_LEASE=600,  # через сколько секунд тайл, взятый упавшим воркером, выдаётся снова
+    TILES_OWNER=None,  # имя этого экземпляра апи в очереди тайлов (по умолчанию имя машины), у нескольких экземпляров на одной машине должно отличаться
+    TILE_MAX_FAILURES=3,  # после скольких падений воркеров тайл больше не выдаётся, а task завершается с ошибкой
+    RESULTS_BATCH_SIZE=500,  # сколько пар за раз пишется в базу данных и читается из неё при отдаче результатов
+    ESTIMATE_HISTORY=200,  # по скольким последним замерам каждого метода подбирается модель стоимости (см. estimate.py)
+    ESTIMATE_MIN_SAMPLES=10,  # пока замеров меньше, используются коэффициенты по умолчанию
+    MAX_ESTIMATED_SECONDS=None,  # task'и с оценкой времени больше этой не принимаются, None - без лимита
+    MAX_ESTIMATED_MEMORY=None,  # то же для оценки памяти в байтах
+    RESULT_CACHE_DAYS=30,  # сколько дней результат task'а отдаётся повторным загрузкам того же архива с теми же параметрами, None - бессрочно
+    RESULT_RETENTION_DAYS=None,  # через сколько дней task'и и их результаты удаляются из базы данных, None - не удаляются
+    RESULT_RETENTION_MAX_TASKS=None  # сколько последних task'ов (пакет считается одним) хранится максимум, None - без ограничения
 )
 
 
@@ -39,18 +58,44 @@ limiter = Limiter(
     storage_uri="memory://"
 )
 
-# инициализация sqlalchemy + api через smorest + ограничителя
-migrate = Migrate(app, db)
+# инициализация sqlalchemy + api через smorest + ограничителя + кэша ответов + очереди тайлов
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"), render_as_batch=True)
 api = Api(app)
 db.init_app(app)
+result_cache.init_app(app)
+tile_coordinator.init_app(app)
 
 # загрузка чертежа и его инициализация
 from upload import blp as upload_blp
 api.register_blueprint(upload_blp)
 
-# инициализация базы данных
+# создание и обновление таблиц базы данных по миграциям (см. migrations/versions),
+# база, созданная через db.create_all() до появления миграций, сначала помечается первой ревизией
 with app.app_context():
-    db.create_all()
+    tables = inspect(db.engine).get_table_names()
+    if "task" in tables and "alembic_version" not in tables:
+        stamp(revision="0001_baseline")
+    upgrade()
+
+# продолжение task'ов, оборвавшихся вместе с прошлым запуском апи, и удаление task'ов с истёкшим сроком хранения.
+# делается перед первым запросом, а не при импорте: application импортируют и консольные команды (flask db migrate и т.п.),
+# которые иначе забрали бы task'и себе и не завершились бы, пока их не досчитают
+from upload import resume_unfinished, purge_expired
+_started = False
+_start_lock = Lock()
+
+
+@app.before_request
+def start_background_work():
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    resume_unfinished(app)
+    purge_expired(app)
 
 #  запуск
 if __name__ == "__main__":
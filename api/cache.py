@@ -0,0 +1,161 @@
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResultCache:
+    """
+    LRU-кэш готовых (уже сериализованных в json) ответов check_status для завершённых task'ов.
+    размер ограничивается не числом записей, а суммарным объёмом в байтах, т.к. отчёты у разных архивов отличаются на порядки
+    ключ - id task'а, значение - тело ответа в bytes
+
+    ответ собирается дольше, чем длится изменение task'а, поэтому у кэша есть счётчик поколений: перед чтением task'а из базы данных берётся generation(),
+    и put не сохраняет ответ, если task успели сбросить (invalidate) после этого, иначе в кэш вернулся бы устаревший ответ
+    """
+    MAX_INVALIDATIONS = 10000  # сколько последних сбросов помнится по task'ам, про более старые помнится только номер поколения
+
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        """
+        :param max_bytes: максимальный суммарный размер хранимых ответов в байтах
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._generation = 0  # растёт с каждым сбросом
+        self._invalidated: OrderedDict[str, int] = OrderedDict()  # id task'а -> поколение его последнего сброса
+        self._forgotten = 0  # последнее поколение, выкинутое из _invalidated
+        self._lock = Lock()  # waitress обслуживает запросы в нескольких потоках
+
+    def init_app(self, app):
+        """
+        берёт размер кэша из конфига фласка (RESULT_CACHE_MAX_BYTES), по аналогии с db.init_app
+        :param app: объект instance'а flask'а
+        """
+        self.max_bytes = app.config.get("RESULT_CACHE_MAX_BYTES", self.max_bytes)
+        with self._lock:
+            self._evict()
+
+    def get(self, task_id: str) -> bytes | None:
+        """
+        :param task_id: id task'а
+        :return: тело ответа, если оно есть в кэше, иначе None
+        """
+        with self._lock:
+            body = self._entries.get(task_id)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(task_id)
+            self.hits += 1
+            return body
+
+    def generation(self) -> int:
+        """
+        :return: текущее поколение кэша, его нужно взять до чтения task'а из базы данных и передать в put
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, task_id: str, body: bytes, generation: int | None = None):
+        """
+        кладёт ответ в кэш и вытесняет самые давно использованные записи, пока не влезем в max_bytes
+        ответы больше всего кэша не сохраняются вовсе
+        :param task_id: id task'а
+        :param body: тело ответа
+        :param generation: поколение, взятое перед чтением task'а (см. generation); если task с тех пор сбрасывали, то ответ устарел и не сохраняется
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and (self._invalidated.get(task_id, 0) > generation or self._forgotten > generation):
+                return
+            old = self._entries.pop(task_id, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._entries[task_id] = body
+            self.current_bytes += len(body)
+            self._evict()
+
+    def invalidate(self, task_id: str):
+        """
+        выкидывает ответ task'а из кэша (вызывается при изменении или удалении task'а, см. models.py)
+        :param task_id: id task'а
+        """
+        with self._lock:
+            old = self._entries.pop(task_id, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._generation += 1
+            self._invalidated.pop(task_id, None)
+            self._invalidated[task_id] = self._generation
+            while len(self._invalidated) > self.MAX_INVALIDATIONS:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        :return: счётчики попаданий/промахов и текущая заполненность кэша
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, body = self._entries.popitem(last=False)
+            self.current_bytes -= len(body)
+
+
+def deep_sizeof(value) -> int:
+    """
+    примерный размер объекта в памяти вместе со вложенными объектами: коллекциями, атрибутами и массивами numpy (у них sys.getsizeof учитывает и данные)
+    :param value: объект (отпечаток copydetect'а, текст, множество хэшей и т.п.)
+    :return: размер в байтах
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, int, float)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(deep_sizeof(key) + deep_sizeof(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(deep_sizeof(item) for item in value)
+    if hasattr(value, "__dict__"):
+        return size + deep_sizeof(vars(value))
+    return size
+
+
+class LRUDict(OrderedDict):
+    """
+    словарь, ограниченный суммарным размером значений в байтах (см. deep_sizeof): при переполнении вытесняются самые давно использованные записи.
+    это общий кэш отпечатков/документов для архивов одного пакета (см. process_batch_background в upload.py), без ограничения он рос бы на весь пакет;
+    ограничивать число записей нельзя, т.к. отпечаток copydetect'а в сотню раз больше самого файла, а документ tf-idf - размером с файл
+    """
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: максимальный суммарный размер хранимых значений в байтах
+        """
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._sizes = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.current_bytes -= self._sizes.pop(key, 0)
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._sizes[key] = deep_sizeof(value)
+        self.current_bytes += self._sizes[key]
+        while self.current_bytes > self.max_bytes and len(self) > 1:  # только что добавленная запись не вытесняется, процессоры сразу её читают
+            old, _ = self.popitem(last=False)
+            self.current_bytes -= self._sizes.pop(old)
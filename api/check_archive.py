@@ -14,7 +14,6 @@ def check_archive(arc: ZipFile | RarFile | TarFile) -> bool:
     paths = [i for i in arc.namelist()]
     initial = paths[0].split('/')[0]
     for path in paths[1:]:
-        print(path)
         if initial in path.split('/')[0]:
             if len(paths) - 1 == paths.index(path):
                 return False
@@ -0,0 +1,313 @@
+import os
+import argparse
+import heapq
+import json
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from tempfile import TemporaryDirectory
+from processors import BaseArchiveProcessor, CopydetectProcessor, VectorProcessor, AstProcessor
+
+
+"""
+запуск проверки на плагиат без апи (без фласка, базы данных и ограничений по числу запросов), например для ночных проверок:
+
+python cli.py contest1.zip contest2.zip ./solutions --method copydetect vector --threshold 0.7 --top-k 20 --output report.jsonl
+
+группы (задача + расширение) делятся на части примерно по PAIRS_PER_JOB пар, и части раздаются по процессам, так что и один большой архив обрабатывается параллельно.
+в обработке одновременно не больше JOBS_PER_WORKER частей на процесс: следующие части (и распаковка следующих архивов) ставятся по мере того, как готовы предыдущие,
+а пары пишутся в jsonl (одна строка - одна пара или один кластер) сразу по готовности части, без сортировки.
+для --top-k из каждой части возвращается только её top-k, и в главном процессе держатся только k лучших пар архива, которые пишутся, когда архив обработан.
+для --clusters пары выше порога (только имена файлов) копятся до конца обработки архива, кластеры строятся по всем таким парам, в том числе вместе с --top-k
+"""
+
+PROCESSORS = {
+    "copydetect": CopydetectProcessor,
+    "vector": VectorProcessor,
+    "ast": AstProcessor
+}
+PAIRS_PER_JOB = 10000  # примерно столько пар группы сравнивается в одной части (у copydetect'а это около 10 секунд)
+JOBS_PER_WORKER = 2  # сколько частей на процесс может быть отправлено, но ещё не получено
+
+_prepared = {}  # группа, подготовленная в этом процессе последней: части одной группы не строят отпечатки/векторы заново
+
+
+def pair_record(path: str, method: str, key: str, value, with_code: bool = False) -> dict:
+    """
+    превращает результат одной пары из процессора в запись
+    :param path: путь до архива/папки
+    :param method: метод обработки
+    :param key: ключ пары вида "буква___расширение___файл1___файл2"
+    :param value: результат сравнения пары
+    :param with_code: добавлять ли в записи copydetect'а коды с подсвеченными совпадениями
+    :return: словарь с записью о паре
+    """
+    letter, extension, file1, file2 = key.split("___", 3)
+    record = {
+        "type": "pair",
+        "archive": path,
+        "method": method,
+        "task": letter,
+        "extension": extension,
+        "file1": file1,
+        "file2": file2
+    }
+    if method == "copydetect":
+        token_overlap, similarity, codes = value
+        record["token_overlap"] = int(token_overlap)
+        record["similarity"] = float(similarity)
+        if with_code:
+            record["code1"], record["code2"] = codes
+    else:
+        record["similarity"] = float(value)
+    return record
+
+
+def plan_jobs(data: tuple[dict, bool]) -> list[tuple[str, list[str], int, int]]:
+    """
+    делит архив на части для процессов: группа режется по строкам верхнего треугольника пар так, чтобы в части было примерно PAIRS_PER_JOB пар
+    :param data: данные решений архива (см. common_extraction)
+    :return: список (группа, пути до файлов группы, первая строка, строка после последней) - в части пары (i, j) для i из строк и всех j > i
+    """
+    jobs = []
+    for key, files in BaseArchiveProcessor.groups(data):
+        start, pairs = 0, 0
+        for row in range(len(files) - 1):
+            pairs += len(files) - 1 - row
+            if pairs >= PAIRS_PER_JOB or row == len(files) - 2:
+                jobs.append((key, files, start, row + 1))
+                start, pairs = row + 1, 0
+    return jobs
+
+
+def group_processor(method: str, key: str):
+    """
+    :param method: метод обработки
+    :param key: группа вида "буква___расширение"
+    :return: процессор, который сравнивает эту группу (ast сравнивает решения не на python через FALLBACK, как и в AstProcessor.iter_pairs)
+    """
+    if method == "ast" and not key.endswith("___py"):
+        return AstProcessor.FALLBACK
+    return PROCESSORS[method]
+
+
+def prepared_group(path: str, method: str, key: str, files: list[str], options: dict):
+    """
+    готовит группу к сравнению пар (отпечатки, TF-IDF векторы или общие поддеревья) или берёт уже подготовленную этим процессом для предыдущей части той же группы
+    :param path: путь до архива/папки
+    :param method: метод обработки
+    :param key: группа вида "буква___расширение"
+    :param files: пути до файлов группы
+    :param options: параметры из командной строки
+    :return: подготовленная группа (см. prepare_group процессоров)
+    """
+    if _prepared.get("group") != (path, method, key):
+        _prepared.clear()
+        processor = group_processor(method, key)
+        if processor is CopydetectProcessor:
+            fingerprints, file_stats, _ = CopydetectProcessor.prepare_group(files, max_df=options["max_df"], bounds=options["threshold"] > 0)
+            prepared = (fingerprints, file_stats)
+        elif processor is AstProcessor:
+            prepared = AstProcessor.prepare_group(files, max_df=options["max_df"])
+        else:
+            prepared = processor.prepare_group(files)
+        _prepared.update(group=(path, method, key), prepared=prepared)
+    return _prepared["prepared"]
+
+
+def run_job(path: str, method: str, key: str, files: list[str], start: int, stop: int, options: dict) -> tuple[list[dict], list[tuple]]:
+    """
+    выполняется в отдельном процессе: сравнивает одним процессором пары одной части группы (строки от start до stop).
+    пары отфильтровываются по порогу по мере того, как процессор их отдаёт, а для top-k держится только куча из k лучших
+    :param path: путь до архива/папки
+    :param method: метод обработки
+    :param key: группа вида "буква___расширение"
+    :param files: пути до файлов группы
+    :param start: первая строка части
+    :param stop: строка после последней
+    :param options: параметры из командной строки
+    :return: записи о парах, уже отфильтрованные по порогу и top-k, и (для кластеров) все пары выше порога в виде (задача, расширение, файл 1, файл 2)
+    """
+    processor = group_processor(method, key)
+    prepared = prepared_group(path, method, key, files, options)
+    pairs = ((i, j) for i in range(start, stop) for j in range(i + 1, len(files)))
+    if processor is CopydetectProcessor:
+        stats = {"pairs": 0, "pruned": 0, "compared": 0}
+        results = CopydetectProcessor.compare_pairs(key, *prepared, pairs, options["threshold"], stats)
+    else:
+        results = processor.compare_pairs(key, prepared, pairs)
+
+    edges = []
+
+    def above_threshold():
+        for pair, value in results:
+            record = pair_record(path, method, pair, value, options["with_code"])
+            if record["similarity"] < options["threshold"]:
+                continue
+            if options["clusters"]:
+                edges.append((record["task"], record["extension"], record["file1"], record["file2"]))
+            yield record
+
+    if options["top_k"] is not None:
+        return heapq.nlargest(options["top_k"], above_threshold(), key=lambda record: record["similarity"]), edges
+    return list(above_threshold()), edges
+
+
+def load(path: str, directories: dict) -> tuple[dict, bool]:
+    """
+    распаковывает архив во временную папку (или раскладывает уже распакованную папку)
+    :param path: путь до архива/папки
+    :param directories: словарь путь -> временная папка, куда добавляется папка архива (удаляется, когда архив обработан)
+    :return: данные решений (см. common_extraction)
+    """
+    if os.path.isdir(path):
+        return BaseArchiveProcessor.collect_directory(path)
+    directories[path] = TemporaryDirectory()
+    return BaseArchiveProcessor.common_extraction(path, directories[path].name)
+
+
+def clusters(path: str, method: str, edges: list[tuple]) -> list[dict]:
+    """
+    объединяет пары выше порога в кластеры (компоненты связности) внутри одной задачи одного архива
+    :param path: путь до архива/папки
+    :param method: метод обработки
+    :param edges: пары выше порога в виде (задача, расширение, файл 1, файл 2)
+    :return: записи о кластерах
+    """
+    parent = {}
+
+    def find(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for task, extension, file1, file2 in edges:
+        group = (task, extension)
+        parent[find((group, file1))] = find((group, file2))
+
+    members = {}
+    for node in parent:
+        members.setdefault(find(node), []).append(node)
+
+    result = []
+    for nodes in members.values():
+        (task, extension), _ = nodes[0]
+        result.append({
+            "type": "cluster",
+            "archive": path,
+            "method": method,
+            "task": task,
+            "extension": extension,
+            "files": sorted(name for _, name in nodes)
+        })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="проверка архивов/папок с кодом на плагиат без апи, результат в формате jsonl")
+    parser.add_argument("paths", nargs="+", help="архивы ('.zip', '.rar', '.tar.gz', '.tgz') или папки с кодом")
+    parser.add_argument("-m", "--method", nargs="+", choices=sorted(PROCESSORS), default=["copydetect", "vector"], help="методы обработки")
+    parser.add_argument("-t", "--threshold", type=float, default=0.0, help="выводить только пары с похожестью не ниже порога (copydetect заодно отсекает такие пары до сравнения)")
+    parser.add_argument("-k", "--top-k", type=int, default=None, help="выводить только k самых похожих пар каждого архива для каждого метода")
+    parser.add_argument("--max-df", type=float, default=None, help="для copydetect'а и ast: игнорировать код, встречающийся в большей доле решений задачи")
+    parser.add_argument("--clusters", action="store_true", help="дополнительно выводить кластеры файлов, связанных парами выше порога (все такие пары, а не только top-k)")
+    parser.add_argument("--with-code", action="store_true", help="добавлять в пары copydetect'а коды с подсвеченными совпадениями")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="число процессов (по умолчанию по числу ядер)")
+    parser.add_argument("-o", "--output", default="-", help="файл для результата, '-' - stdout")
+    args = parser.parse_args(argv)
+
+    options = {"threshold": args.threshold, "top_k": args.top_k, "max_df": args.max_df, "with_code": args.with_code, "clusters": args.clusters}
+    workers = args.workers or os.cpu_count() or 1
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    failed = False
+    directories = {}
+    remaining = defaultdict(int)  # (архив, метод) -> число отправленных и ещё не полученных частей
+    planned = set()  # (архив, метод), все части которых уже отправлены
+    top = defaultdict(list)  # (архив, метод) -> k лучших пар
+    edges = defaultdict(list)  # (архив, метод) -> пары выше порога для кластеров
+    broken = set()
+    finished_methods = defaultdict(int)
+
+    def write(record: dict):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def finish(path: str, method: str):
+        # все части архива для метода получены: пишутся top-k и кластеры, а когда готовы все методы - удаляется распакованный архив
+        if (path, method) not in broken:
+            for record in top.pop((path, method), []):
+                write(record)
+            if args.clusters:
+                for cluster in clusters(path, method, edges.pop((path, method), [])):
+                    write(cluster)
+        finished_methods[path] += 1
+        if finished_methods[path] == len(args.method) and path in directories:
+            directories.pop(path).cleanup()
+
+    def iter_jobs():
+        # архивы распаковываются по одному, только когда до их частей доходит очередь
+        nonlocal failed
+        for path in dict.fromkeys(args.paths):
+            try:
+                data = load(path, directories)
+            except Exception as e:
+                failed = True
+                print(f"ошибка обработки {path}: {e}", file=sys.stderr)
+                continue
+
+            jobs = plan_jobs(data)
+            for method in args.method:
+                if method == "copydetect" and not jobs:
+                    failed = True
+                    print(f"ошибка обработки {path} ({method}): в архиве нет ни одной пары файлов для сравнения", file=sys.stderr)
+                for job in jobs:
+                    yield path, method, job
+                planned.add((path, method))
+                if not remaining[(path, method)]:
+                    finish(path, method)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = iter_jobs()
+            pending = {}
+            while True:
+                for path, method, (key, files, start, stop) in jobs:
+                    pending[pool.submit(run_job, path, method, key, files, start, stop, options)] = (path, method)
+                    remaining[(path, method)] += 1
+                    if len(pending) >= JOBS_PER_WORKER * workers:
+                        break
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, method = pending.pop(future)
+                    try:
+                        records, found = future.result()
+                    except Exception as e:
+                        failed = True
+                        broken.add((path, method))
+                        print(f"ошибка обработки {path} ({method}): {e}", file=sys.stderr)
+                        records, found = [], []
+
+                    if args.top_k is not None:
+                        top[(path, method)] = heapq.nlargest(args.top_k, top[(path, method)] + records, key=lambda record: record["similarity"])
+                    else:
+                        for record in records:
+                            write(record)
+                    edges[(path, method)].extend(found)
+
+                    remaining[(path, method)] -= 1
+                    if not remaining[(path, method)] and (path, method) in planned:
+                        finish(path, method)
+                output.flush()
+    finally:
+        for directory in directories.values():
+            directory.cleanup()
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import numpy as np
+from flask import current_app
+from scipy.optimize import nnls
+from extensions import db
+from models import TaskTiming
+
+
+"""
+оценка стоимости обработки архива до её начала: по оглавлению архива (см. BaseArchiveProcessor.manifest) считаются файлы, байты и пары в группах,
+а время работы каждого метода предсказывается линейной моделью  секунды = c0 + c1 * файлы + c2 * байты + c3 * пары,
+коэффициенты которой подбираются по времени прошлых task'ов (таблица task_timing, неотрицательный метод наименьших квадратов).
+пока прошлых замеров меньше ESTIMATE_MIN_SAMPLES, используются коэффициенты, замеренные на sample_yandex_contest.zip
+
+память замерить по task'у нельзя (task'и обрабатываются потоками одного процесса), поэтому она оценивается по формуле:
+copydetect держит токены и отпечатки файлов группы (~160 байт на байт кода по tracemalloc), vector - tf-idf группы (~12 байт на байт кода) и матрицу похожести самой большой группы, ast - хэши поддеревьев (столько же) и матрицу общих поддеревьев
+"""
+
+DEFAULT_COEFFICIENTS = {
+    "copydetect": (0.1, 0.0, 1e-5, 9e-4),
+    "vector": (0.1, 0.01, 1e-6, 1e-4),
+    "ast": (0.1, 0.01, 2e-6, 5e-5)
+}
+MEMORY_PER_BYTE = {
+    "copydetect": 160,
+    "vector": 12,
+    "ast": 12
+}
+
+
+def features(manifest: dict) -> dict:
+    """
+    :param manifest: оглавление архива (см. BaseArchiveProcessor.manifest)
+    :return: число файлов, байт и пар архива, а также размеры самой большой группы
+    """
+    groups = manifest["groups"].values()
+    return {
+        "files": sum(group["files"] for group in groups),
+        "bytes": sum(group["bytes"] for group in groups),
+        "pairs": sum(group["files"] * (group["files"] - 1) // 2 for group in groups),
+        "max_group_files": max((group["files"] for group in groups), default=0),
+        "max_group_bytes": max((group["bytes"] for group in groups), default=0)
+    }
+
+
+def coefficients(method: str) -> tuple[np.ndarray, int]:
+    """
+    подбирает коэффициенты модели времени по последним ESTIMATE_HISTORY замерам метода
+    :param method: метод обработки
+    :return: коэффициенты (c0, c1, c2, c3) и число замеров, по которым они подобраны (0 - коэффициенты по умолчанию)
+    """
+    rows = (
+        db.session.query(TaskTiming.files, TaskTiming.bytes, TaskTiming.pairs, TaskTiming.seconds)
+        .filter_by(method=method)
+        .order_by(TaskTiming.id.desc())
+        .limit(current_app.config["ESTIMATE_HISTORY"])
+        .all()
+    )
+    if len(rows) < current_app.config["ESTIMATE_MIN_SAMPLES"]:
+        return np.array(DEFAULT_COEFFICIENTS[method]), 0
+
+    data = np.array(rows, dtype=float)
+    x = np.column_stack([np.ones(len(data)), data[:, :3]])
+    scale = x.max(axis=0)  # столбцы отличаются на порядки (файлы и байты), без нормировки nnls теряет точность
+    solution, _ = nnls(x / scale, data[:, 3])
+    return solution / scale, len(rows)
+
+
+def estimate(manifests: list[dict], methods: list[str]) -> dict:
+    """
+    предсказывает время и память обработки архивов выбранными методами (архивы пакета обрабатываются друг за другом, поэтому время складывается)
+    :param manifests: оглавления архивов (см. BaseArchiveProcessor.manifest)
+    :param methods: методы обработки
+    :return: словарь с оценкой всего task'а и каждого метода отдельно
+    """
+    archives = [features(manifest) for manifest in manifests]
+    result = {
+        "files": sum(archive["files"] for archive in archives),
+        "bytes": sum(archive["bytes"] for archive in archives),
+        "pairs": sum(archive["pairs"] for archive in archives),
+        "seconds": 0.0,
+        "memory_bytes": 0,
+        "methods": {}
+    }
+    for method in methods:
+        coefs, samples = coefficients(method)
+        seconds = float(sum(coefs @ (1, archive["files"], archive["bytes"], archive["pairs"]) for archive in archives))
+        memory = max((memory_bytes(method, archive) for archive in archives), default=0)
+        result["methods"][method] = {"seconds": round(seconds, 2), "memory_bytes": memory, "samples": samples}
+        result["seconds"] += seconds
+        result["memory_bytes"] = max(result["memory_bytes"], memory)
+    result["seconds"] = round(result["seconds"], 2)
+    return result
+
+
+def memory_bytes(method: str, archive: dict) -> int:
+    """
+    :param method: метод обработки
+    :param archive: признаки архива (см. features)
+    :return: оценка пиковой памяти метода в байтах (группы обрабатываются по очереди, поэтому важна только самая большая)
+    """
+    memory = MEMORY_PER_BYTE[method] * archive["max_group_bytes"]
+    if method in ("vector", "ast"):
+        memory += 8 * archive["max_group_files"] ** 2  # матрица похожести группы (у ast - матрица общих поддеревьев)
+    return int(memory)
+
+
+def check_limits(result: dict) -> str | None:
+    """
+    сравнивает оценку с лимитами из конфига (MAX_ESTIMATED_SECONDS, MAX_ESTIMATED_MEMORY, None - без лимита)
+    :param result: оценка (см. estimate)
+    :return: причина отказа или None, если task укладывается в лимиты
+    """
+    max_seconds = current_app.config["MAX_ESTIMATED_SECONDS"]
+    max_memory = current_app.config["MAX_ESTIMATED_MEMORY"]
+    if max_seconds is not None and result["seconds"] > max_seconds:
+        return f"оценка времени обработки {result['seconds']:.0f} с больше лимита {max_seconds} с, разбейте архив на части"
+    if max_memory is not None and result["memory_bytes"] > max_memory:
+        return f"оценка памяти для обработки {result['memory_bytes'] / 2**20:.0f} MB больше лимита {max_memory / 2**20:.0f} MB, разбейте архив на части"
+    return None
+
+
+def record_timing(task_id: str, method: str, manifest: dict, seconds: float):
+    """
+    сохраняет замер времени метода, по которому потом подбираются коэффициенты модели (см. coefficients)
+    :param task_id: id task'а
+    :param method: метод обработки
+    :param manifest: оглавление архива (см. BaseArchiveProcessor.manifest)
+    :param seconds: сколько секунд метод обрабатывал архив
+    """
+    archive = features(manifest)
+    db.session.add(TaskTiming(
+        task_id=task_id,
+        method=method,
+        files=archive["files"],
+        bytes=archive["bytes"],
+        pairs=archive["pairs"],
+        seconds=seconds
+    ))
+    db.session.commit()
@@ -1,5 +1,9 @@
 #  нужен дабы избежать circular import
 
 from flask_sqlalchemy import SQLAlchemy
+from cache import ResultCache
+from tiles import TileCoordinator
 
-db = SQLAlchemy()
\ No newline at end of file
+db = SQLAlchemy()
+result_cache = ResultCache()
+tile_coordinator = TileCoordinator()
@@ -0,0 +1,31 @@
+"""task table as created by db.create_all() before migrations were added
+
+Revision ID: 0001_baseline
+Revises: 
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_baseline'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task',
+    sa.Column('id', sa.String(length=35), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('results', sa.JSON(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('archive_name', sa.String(length=100), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('task')
@@ -0,0 +1,30 @@
+"""task.parent_id for archives of a batch upload
+
+Revision ID: 0002_task_parent
+Revises: 0001_baseline
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_task_parent'
+down_revision = '0001_baseline'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('parent_id', sa.String(length=35), nullable=True))
+        batch_op.create_index(batch_op.f('ix_task_parent_id'), ['parent_id'], unique=False)
+        batch_op.create_foreign_key('fk_task_parent_id_task', 'task', ['parent_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_task_parent_id_task', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_task_parent_id'))
+        batch_op.drop_column('parent_id')
@@ -0,0 +1,56 @@
+"""pair_result and task_timing tables
+
+Revision ID: 0003_pair_results_timings
+Revises: 0002_task_parent
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_pair_results_timings'
+down_revision = '0002_task_parent'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pair_result',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('task_id', sa.String(length=35), nullable=False),
+    sa.Column('method', sa.String(length=20), nullable=False),
+    sa.Column('pair', sa.Text(), nullable=False),
+    sa.Column('value', sa.JSON(), nullable=True),
+    sa.ForeignKeyConstraint(['task_id'], ['task.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('pair_result', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_pair_result_task_id'), ['task_id'], unique=False)
+
+    op.create_table('task_timing',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('task_id', sa.String(length=35), nullable=True),
+    sa.Column('method', sa.String(length=20), nullable=False),
+    sa.Column('files', sa.Integer(), nullable=False),
+    sa.Column('bytes', sa.Integer(), nullable=False),
+    sa.Column('pairs', sa.Integer(), nullable=False),
+    sa.Column('seconds', sa.Float(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['task_id'], ['task.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('task_timing', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_task_timing_method'), ['method'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task_timing', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_timing_method'))
+
+    op.drop_table('task_timing')
+    with op.batch_alter_table('pair_result', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pair_result_task_id'))
+
+    op.drop_table('pair_result')
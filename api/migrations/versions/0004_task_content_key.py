@@ -0,0 +1,28 @@
+"""task.content_key for reusing results of identical uploads
+
+Revision ID: 0004_task_content_key
+Revises: 0003_pair_results_timings
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_task_content_key'
+down_revision = '0003_pair_results_timings'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_key', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_task_content_key'), ['content_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_content_key'))
+        batch_op.drop_column('content_key')
@@ -1,5 +1,7 @@
 from datetime import datetime
-from extensions import db
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from extensions import db, result_cache
 
 class Task(db.Model):
     """
@@ -10,6 +12,68 @@ class Task(db.Model):
     results = db.Column(db.JSON)  # сохраняет результаты обработок
     created_at = db.Column(db.DateTime, default=datetime.now)
     archive_name = db.Column(db.String(100), default="undefined")
+    parent_id = db.Column(db.String(35), db.ForeignKey("task.id"), nullable=True, index=True)  # id пакетного task'а, если архив пришёл в пакете (см. /api/archives/batch/)
+    content_key = db.Column(db.String(64), nullable=True, index=True)  # хэш архива и параметров обработки, по нему повторные загрузки получают готовый результат (см. content_key в upload.py)
 
     def __repr__(self):
-        return f"Task(id={self.id}, status={self.status})"
\ No newline at end of file
+        return f"Task(id={self.id}, status={self.status})"
+
+
+class PairResult(db.Model):
+    """
+    модель для хранения результата сравнения одной пары файлов одним процессором.
+    процессоры отдают пары по одной (см. iter_pairs), и они пишутся сюда пачками, а не собираются в один огромный json в Task.results
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String(35), db.ForeignKey("task.id"), nullable=False, index=True)
+    method = db.Column(db.String(20), nullable=False)  # copydetect, vector
+    pair = db.Column(db.Text, nullable=False)  # ключ пары вида "буква___расширение___файл1___файл2"
+    value = db.Column(db.JSON)  # результат сравнения пары
+
+    def __repr__(self):
+        return f"PairResult(task_id={self.task_id}, method={self.method}, pair={self.pair})"
+
+
+class TaskTiming(db.Model):
+    """
+    модель для хранения замера времени обработки архива одним методом вместе с размерами архива по его оглавлению.
+    по этим замерам подбирается модель стоимости для оценки новых task'ов до начала обработки (см. estimate.py)
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String(35), db.ForeignKey("task.id"), nullable=True)  # None, если task уже удалён по сроку хранения (см. purge_expired в upload.py)
+    method = db.Column(db.String(20), nullable=False, index=True)  # copydetect, vector
+    files = db.Column(db.Integer, nullable=False)
+    bytes = db.Column(db.Integer, nullable=False)
+    pairs = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"TaskTiming(task_id={self.task_id}, method={self.method}, seconds={self.seconds})"
+
+
+@event.listens_for(Task, "after_update")
+@event.listens_for(Task, "after_delete")
+def remember_changed_task(mapper, connection, target):
+    """
+    запоминает изменённый или удалённый task, его закэшированный ответ check_status сбрасывается после коммита (см. invalidate_cached_tasks)
+    """
+    object_session(target).info.setdefault("changed_tasks", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_cached_tasks(session):
+    """
+    сбрасывает закэшированные ответы check_status изменённых task'ов (см. cache.py). сброс делается после коммита, а не при flush'е:
+    до коммита другие потоки ещё читают из базы данных старый task и могли бы положить в кэш старый ответ уже после сброса
+    """
+    for task_id in session.info.pop("changed_tasks", ()):
+        result_cache.invalidate(task_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_tasks(session):
+    """
+    изменения откатились, и закэшированные ответы остаются верными
+    """
+    session.info.pop("changed_tasks", None)
@@ -1,13 +1,19 @@
+import io
+import ast
 import os
 import re
+import copy
+import hashlib
 import zipfile
 import tarfile
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, Counter
 from tempfile import TemporaryDirectory
-from typing import Any
+from typing import Any, Iterator
 from pathlib import Path
 import copydetect
+import numpy as np
+from scipy import sparse
 import rarfile
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
@@ -70,28 +76,12 @@ class BaseArchiveProcessor(ABC):
                 name = name_parts[1] if len(name_parts) >= 2 else "Unknown"
 
                 letter = file_part[0]
-                file_path = Path(file_part)
 
                 ident = file_part.split("-")[1]
                 if not ident:
                     ident = "unidentified"
-                extension = file_path.suffix
-
-                if not extension:
-                    if "gcc" in file_part:
-                        extension = '.cpp'
-                        extension_clean = 'cpp'
-                    elif "pypy" in file_part:
-                        extension = '.py'
-                        extension_clean = 'py'
-                    elif "golang" in file_part:
-                        extension = '.go'
-                        extension_clean = 'go'
-                    else:
-                        extension = '.txt'
-                        extension_clean = 'txt'
-                else:
-                    extension_clean = extension.lstrip('.')
+                extension_clean = BaseArchiveProcessor._contest_extension(file_part)
+                extension = f".{extension_clean}"
 
                 new_filename = f"{letter}-{name}_{surname}_{ident}-OK{extension}"
 
@@ -154,23 +144,170 @@ class BaseArchiveProcessor(ABC):
 
                     solutions[letter] = dict(extensions_dict)
         else:
-            extract_path = Path(extract_dir)
-            extensions_dict = defaultdict(list)
+            solutions, _ = BaseArchiveProcessor.collect_directory(extract_dir)
 
-            for file_path in extract_path.rglob('*'):
-                if file_path.is_file():
-                    extension = file_path.suffix[1:] if file_path.suffix else 'none'
-                    extensions_dict[extension].append(str(file_path.resolve()))
+        return dict(solutions), checked
 
-            for extension in extensions_dict:
-                solutions[extension] = extensions_dict[extension]
+    @staticmethod
+    def _contest_extension(file_part: str) -> str:
+        """
+        определяет расширение решения из контеста: у части решений его нет, и тогда оно угадывается по компилятору в имени файла
+        :param file_part: имя файла решения в архиве контеста
+        :return: расширение без точки
+        """
+        suffix = Path(file_part).suffix
+        if suffix:
+            return suffix.lstrip('.')
+        if "gcc" in file_part:
+            return 'cpp'
+        if "pypy" in file_part:
+            return 'py'
+        if "golang" in file_part:
+            return 'go'
+        return 'txt'
 
-        return dict(solutions), checked
+    @staticmethod
+    def manifest(archive_path: str) -> dict:
+        """
+        читает только оглавление архива (без распаковки) и считает, сколько файлов и байт попадёт в каждую группу сравнения (см. groups)
+        нужен для оценки стоимости обработки до её начала (см. estimate.py)
+        :param archive_path: путь до архива
+        :return: словарь {"contest": архив из контеста, "groups": {"буква___расширение": {"files": число файлов, "bytes": их размер}}}
+        """
+        archive_path = Path(archive_path)
+        main_suffix = "".join(archive_path.suffixes[-2:]).lower()
+        try:
+            if archive_path.suffix.lower() == ".zip":
+                archive = zipfile.ZipFile(archive_path, "r")
+            elif archive_path.suffix.lower() == ".rar":
+                archive = rarfile.RarFile(archive_path, "r")
+            elif main_suffix == ".tar.gz" or main_suffix == ".tgz":
+                archive = tarfile.open(archive_path, "r")
+            else:
+                raise ValueError(f"формат {archive_path.suffix} архива не поддерживается")
+        except (zipfile.BadZipFile, rarfile.BadRarFile, tarfile.TarError) as e:
+            raise ValueError(f"неверный архив (повреждённый): {str(e)}")
+
+        with archive:
+            if isinstance(archive, tarfile.TarFile):
+                entries = [(member.name, member.size) for member in archive.getmembers() if member.isfile()]
+                checked = False  # check_archive работает только с namelist(), tar'ы распаковываются как обычные папки
+            else:
+                entries = [(info.filename, info.file_size) for info in archive.infolist() if not info.filename.endswith("/")]
+                checked = bool(entries) and check_archive(archive)
+
+        groups = defaultdict(lambda: {"files": 0, "bytes": 0})
+        for name, size in entries:
+            if checked:
+                parts = name.split('/')
+                if "-OK" not in name or len(parts) != 2:
+                    continue
+                key = f"{parts[1][0].upper()}___{BaseArchiveProcessor._contest_extension(parts[1])}"
+            else:
+                suffix = Path(name).suffix
+                key = f"A___{suffix[1:] if suffix else 'none'}"
+            groups[key]["files"] += 1
+            groups[key]["bytes"] += size
+        return {"contest": checked, "groups": dict(groups)}
+
+    @staticmethod
+    def collect_directory(directory: str) -> tuple[dict, bool]:
+        """
+        раскладывает файлы уже распакованной папки с кодом по расширениям (как для архива не из контеста)
+        :param directory: путь до папки с файлами с кодом
+        :return: словарь расширение -> пути до файлов и False (признак того, что это не контест)
+        """
+        extensions_dict = defaultdict(list)
+
+        for file_path in Path(directory).rglob('*'):
+            if file_path.is_file():
+                extension = file_path.suffix[1:] if file_path.suffix else 'none'
+                extensions_dict[extension].append(str(file_path.resolve()))
+
+        return dict(extensions_dict), False
+
+    @staticmethod
+    def extract_nested_archives(archive_path: str, extract_dir: str, extensions: set[str], max_archives: int | None = None) -> list[str]:
+        """
+        нужна для пакетной загрузки: если архив состоит только из архивов (например, выгрузки нескольких контестов), то распаковывает их в extract_dir
+        :param archive_path: путь до внешнего архива
+        :param extract_dir: папка, куда распаковываются вложенные архивы
+        :param extensions: допустимые расширения архивов (ALLOWED_EXTENSIONS из конфига)
+        :param max_archives: сколько вложенных архивов можно распаковать (MAX_BATCH_ARCHIVES из конфига), None - без ограничения
+        :return: пути до вложенных архивов или пустой список, если это обычный архив с кодом
+        """
+        archive_path = Path(archive_path)
+        main_suffix = "".join(archive_path.suffixes[-2:]).lower()
+        try:
+            if archive_path.suffix.lower() == ".zip":
+                archive = zipfile.ZipFile(archive_path, "r")
+            elif archive_path.suffix.lower() == ".rar":
+                archive = rarfile.RarFile(archive_path, "r")
+            elif main_suffix == ".tar.gz" or main_suffix == ".tgz":
+                archive = tarfile.open(archive_path, "r")
+            else:
+                raise ValueError(f"формат {archive_path.suffix} архива не поддерживается")
+        except (zipfile.BadZipFile, rarfile.BadRarFile, tarfile.TarError) as e:
+            raise ValueError(f"неверный архив (повреждённый): {str(e)}")
+
+        with archive:
+            names = archive.getnames() if isinstance(archive, tarfile.TarFile) else archive.namelist()
+            names = [name for name in names if not name.endswith("/")]
+            if not names or not all(any(name.lower().endswith(f".{ext}") for ext in extensions) for name in names):
+                return []
+            if max_archives is not None and len(names) > max_archives:
+                raise ValueError(f"в пакете может быть не больше {max_archives} архивов, а в архиве их {len(names)}")
+
+            nested = []
+            for index, name in enumerate(names):
+                target_dir = os.path.join(extract_dir, str(index))  # у вложенных архивов могут совпадать имена
+                os.makedirs(target_dir, exist_ok=True)
+                target_path = os.path.join(target_dir, Path(name).name)
+                source = archive.extractfile(name) if isinstance(archive, tarfile.TarFile) else archive.open(name)
+                with source, open(target_path, "wb") as target:
+                    target.write(source.read())
+                nested.append(target_path)
+            return nested
+
+    @staticmethod
+    def groups(data: tuple[dict, bool]) -> list[tuple[str, list[str]]]:
+        """
+        раскладывает данные решений (см. common_extraction) на группы, внутри которых сравниваются пары
+        :param data: словарь с данными о решениях учеников и признак архива из контеста
+        :return: список пар ("буква задачи___расширение", пути до файлов группы), файлы отсортированы по имени, чтобы порядок не зависел от файловой системы
+        """
+        if data[1]:
+            return [
+                (f"{letter}___{extension}", sorted(files, key=lambda file: Path(file).name))
+                for letter in data[0] for extension, files in data[0][letter].items()
+            ]
+        return [(f"A___{extension}", sorted(files, key=lambda file: Path(file).name)) for extension, files in data[0].items()]
+
+    @classmethod
+    def iter_path(cls, path: str, **kwargs) -> Iterator[tuple[str, Any]]:
+        """
+        генератор: распаковывает архив (или берёт папку) и отдаёт результаты пар по одной, не собирая весь отчёт в памяти
+        :param path: путь до архива или папки
+        :param kwargs: дополнительные параметры, которые передаются в iter_pairs конкретного процессора
+        :return: пары (ключ пары, результат сравнения)
+        """
+        if os.path.isdir(path):
+            yield from cls.iter_pairs(cls.collect_directory(path), **kwargs)
+            return
+
+        with TemporaryDirectory() as extract_dir:
+            try:
+                data = cls.common_extraction(path, extract_dir)
+            except (zipfile.BadZipFile, rarfile.BadRarFile) as e:
+                raise ValueError(f"неверный архив (повреждённый): {str(e)}")
+
+            yield from cls.iter_pairs(data, **kwargs)
 
     @classmethod
-    def process_archive(cls, archive_path: str) -> Any:
+    def process_archive(cls, archive_path: str, **kwargs) -> Any:
         """
         :param archive_path: указывается путь до архива
+        :param kwargs: дополнительные параметры, которые передаются в analyze_files конкретного процессора
         :return: возвращает результат анализа на плагиат (поскольку это базовый класс, то в данном случае ничего не будет возвращаться, см. наследников)
         """
         with TemporaryDirectory() as extract_dir:
@@ -179,12 +316,42 @@ class BaseArchiveProcessor(ABC):
             except (zipfile.BadZipFile, rarfile.BadRarFile) as e:
                 raise ValueError(f"неверный архив (повреждённый): {str(e)}")
 
-            return cls.analyze_files(data)
+            return cls.analyze_files(data, **kwargs)
+
+    @classmethod
+    def process_path(cls, path: str, **kwargs) -> Any:
+        """
+        то же, что process_archive, но принимает ещё и уже распакованную папку с кодом (нужно для запуска без апи, см. cli.py)
+        :param path: путь до архива или папки
+        :param kwargs: дополнительные параметры, которые передаются в analyze_files конкретного процессора
+        :return: результат анализа на плагиат
+        """
+        if os.path.isdir(path):
+            return cls.analyze_files(cls.collect_directory(path), **kwargs)
+        return cls.process_archive(path, **kwargs)
+
+    @staticmethod
+    def _content_key(file: str) -> str:
+        """
+        :param file: путь до файла с кодом
+        :return: хэш содержимого файла (одинаковые файлы из разных архивов получают одинаковый ключ)
+        """
+        with open(file, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @classmethod
+    def analyze_files(cls, data: tuple[dict, bool], **kwargs) -> dict:
+        """
+        :param data: указывается словарь/список с данными о решениях учеников (заполняется автоматом, см. BaseArchiveProcessor)
+        :param kwargs: дополнительные параметры, которые передаются в iter_pairs конкретного процессора
+        :return: весь отчёт словарём (ключ пары -> результат сравнения); для больших архивов лучше читать iter_pairs/iter_path по мере готовности
+        """
+        return dict(cls.iter_pairs(data, **kwargs))
 
     @staticmethod
     @abstractmethod
-    def analyze_files(data: tuple[dict, bool]) -> Any:
-        """метод будет определён в наследующихся процессорах"""
+    def iter_pairs(data: tuple[dict, bool], **kwargs) -> Iterator[tuple[str, Any]]:
+        """метод будет определён в наследующихся процессорах: генератор, отдающий пары (ключ пары, результат сравнения)"""
         pass
 
 
@@ -193,38 +360,182 @@ class CopydetectProcessor(BaseArchiveProcessor):
     процессор, использующий библиотеку copydetect.
     токенизирует код файла, сравнивает уникальные пары токенизированных кодов и имен их файлов, возвращает значения совпадения токенов, похожесть, а также предпологаемые части сплагиаченного кода (отмечены SUS_FROM_HERE--> <--TO_HERE)
     """
+
+    @staticmethod
+    def _fingerprint(file: str, cache: dict | None = None) -> copydetect.CodeFingerprint:
+        """
+        строит отпечаток файла, а если передан общий кэш, то переиспользует уже построенный отпечаток файла с таким же содержимым
+        :param file: путь до файла с кодом
+        :param cache: общий словарь отпечатков (хэш содержимого -> отпечаток), см. пакетную обработку в upload.py
+        :return: отпечаток copydetect'а
+        """
+        if cache is None:
+            return copydetect.CodeFingerprint(file, 25, 1)
+        key = ("copydetect", CopydetectProcessor._content_key(file))
+        if key not in cache:
+            cache[key] = copydetect.CodeFingerprint(file, 25, 1)
+        return cache[key]
+
+    @staticmethod
+    def boilerplate_hashes(files: list[tuple[str, str]]) -> set[int]:
+        """
+        строит отпечатки загруженных пользователем шаблонных файлов (стартовый код учителя, шаблоны быстрого ввода/вывода и т.п.)
+        :param files: список пар (имя файла, код файла); по расширению имени copydetect выбирает лексер
+        :return: множество хэшей, которые надо выкинуть из отпечатков решений (см. _subtract_hashes)
+        """
+        hashes = set()
+        for name, code in files:
+            hashes |= {int(h) for h in copydetect.CodeFingerprint(name, 25, 1, fp=io.StringIO(code)).hashes}
+        return hashes
+
     @staticmethod
-    def analyze_files(data: tuple[dict, bool]) -> dict:
+    def _subtract_hashes(fp: copydetect.CodeFingerprint, hashes: set) -> copydetect.CodeFingerprint:
+        """
+        убирает из отпечатка общие/шаблонные хэши. отпечаток копируется, т.к. он может лежать в общем кэше пакета и использоваться в других группах
+        :param fp: отпечаток copydetect'а
+        :param hashes: хэши, которые нужно убрать
+        :return: новый отпечаток без этих хэшей (с пересчитанным покрытием токенов)
+        """
+        stripped = copy.copy(fp)
+        stripped.hashes = fp.hashes - hashes
+        stripped.hash_idx = {h: idx for h, idx in fp.hash_idx.items() if h not in hashes}
+        stripped.token_coverage = copydetect.utils.get_token_coverage(stripped.hash_idx, fp.k, len(fp.filtered_code))
+        return stripped
+
+    @staticmethod
+    def _common_hashes(fingerprints: list[copydetect.CodeFingerprint], max_df: float) -> set:
+        """
+        считает, в какой доле решений группы встречается каждый хэш (document frequency)
+        :param fingerprints: отпечатки решений одной группы (буква задачи + расширение)
+        :param max_df: максимальная доля решений, в которой хэш ещё считается значимым
+        :return: хэши, которые встречаются в большей доле решений, чем max_df (общий для всех код)
+        """
+        if len(fingerprints) < 3:
+            return set()  # в паре любой общий хэш встречается в 100% решений, фильтровать по частоте нечего
+        frequency = Counter(h for fp in fingerprints for h in fp.hashes)
+        return {h for h, count in frequency.items() if count / len(fingerprints) > max_df}
+
+    @staticmethod
+    def _file_stats(fp: copydetect.CodeFingerprint) -> tuple:
+        """
+        один раз на файл переводит отпечаток в отсортированные массивы numpy, чтобы оценка пар (см. _similarity_bound) не строила python-множества
+        :param fp: отпечаток copydetect'а
+        :return: кортеж (число токенов, покрытых отпечатками; отсортированные уникальные хэши; позиции всех вхождений хэшей по возрастанию; хэши в этих позициях)
+        """
+        hashes = np.sort(np.fromiter(fp.hashes, dtype=np.int64, count=len(fp.hashes)))
+        positions = np.fromiter((p for idx in fp.hash_idx.values() for p in idx), dtype=np.int64)
+        position_hashes = np.fromiter((h for h, idx in fp.hash_idx.items() for _ in idx), dtype=np.int64, count=len(positions))
+        order = np.argsort(positions, kind="stable")
+        coverage = fp.token_coverage if len(fp.filtered_code) > 0 else 0
+        return coverage, hashes, positions[order], position_hashes[order]
+
+    @staticmethod
+    def _covered_tokens(fp: copydetect.CodeFingerprint, stats: tuple, shared: np.ndarray) -> int:
+        """
+        :param fp: отпечаток copydetect'а
+        :param stats: характеристики файла (см. _file_stats)
+        :param shared: общие с другим файлом хэши
+        :return: сколько токенов файла покрывают окна длины k, начинающиеся в позициях общих хэшей (то же, что token_overlap у compare_files, но без slices и offsets)
+        """
+        if not len(shared):
+            return 0
+        index = np.searchsorted(shared, stats[3])  # какие позиции файла начинаются с общего хэша: бинарный поиск по отсортированным общим хэшам
+        index[index == len(shared)] = 0
+        positions = stats[2][shared[index] == stats[3]]
+        return int(np.minimum(np.diff(positions), fp.k).sum()) + fp.k
+
+    @staticmethod
+    def _similarity_bound(fp1: copydetect.CodeFingerprint, fp2: copydetect.CodeFingerprint, stats1: tuple, stats2: tuple, min_similarity: float) -> bool:
+        """
+        решает, может ли пара набрать min_similarity по compare_files: похожесть считается по токенам, покрытым общими хэшами,
+        поэтому по точному пересечению хэшей и покрытию токенов можно посчитать её максимум, не строя slices и подсветку
+        :return: True, если пару нужно сравнивать
+        """
+        (coverage1, hashes1), (coverage2, hashes2) = stats1[:2], stats2[:2]
+        if not coverage1 or not coverage2:
+            return False
+
+        shared = np.intersect1d(hashes1, hashes2, assume_unique=True)
+        bound1 = min(coverage1, CopydetectProcessor._covered_tokens(fp1, stats1, shared)) / coverage1
+        bound2 = min(coverage2, CopydetectProcessor._covered_tokens(fp2, stats2, shared)) / coverage2
+        return (bound1 + bound2) / 2 >= min_similarity
+
+    @staticmethod
+    def prepare_group(files: list[str], cache: dict | None = None, max_df: float | None = None, boilerplate=None, bounds: bool = True) -> tuple[list, list, int]:
+        """
+        строит отпечатки всех файлов одной задачи с одним расширением: из них убираются шаблонные хэши и хэши, встречающиеся почти во всех решениях группы,
+        и для каждого готовятся массивы для оценки пар сверху (см. _file_stats)
+        :param files: пути до файлов группы
+        :param cache: общий словарь отпечатков (см. _fingerprint)
+        :param max_df: см. _common_hashes, None - не фильтровать по частоте
+        :param boilerplate: хэши шаблонного кода (см. boilerplate_hashes)
+        :param bounds: считать ли характеристики для оценки пар сверху (без порога похожести они не нужны)
+        :return: список пар (имя файла, отпечаток), список характеристик файлов (None, если bounds=False) и число выкинутых хэшей
+        """
+        fingerprints = [(Path(file).name, CopydetectProcessor._fingerprint(file, cache)) for file in files]
+        dropped = set(boilerplate or ())
+        if max_df is not None:
+            dropped |= CopydetectProcessor._common_hashes([fp for _, fp in fingerprints], max_df)
+        dropped_count = 0
+        if dropped:
+            dropped_count = len(set().union(*(fp.hashes & dropped for _, fp in fingerprints)))
+            fingerprints = [(name, CopydetectProcessor._subtract_hashes(fp, dropped)) for name, fp in fingerprints]
+        file_stats = [CopydetectProcessor._file_stats(fp) if bounds else None for _, fp in fingerprints]
+        return fingerprints, file_stats, dropped_count
+
+    @staticmethod
+    def compare_pairs(prefix: str, fingerprints: list, file_stats: list, pairs, min_similarity: float, stats: dict) -> Iterator[tuple[str, tuple]]:
+        """
+        генератор: сравнивает указанные пары файлов группы и отдаёт результаты по одному
+        пары, у которых максимально возможная похожесть меньше min_similarity, отсекаются без вызова compare_files (при min_similarity <= 0 оценка не считается вовсе)
+        :param prefix: начало ключа пары ("буква задачи___расширение")
+        :param fingerprints: пары (имя файла, отпечаток), см. prepare_group
+        :param file_stats: характеристики файлов, см. prepare_group
+        :param pairs: итерируемое пар индексов файлов (i, j), i < j
+        :param min_similarity: минимальная интересующая похожесть
+        :param stats: словарь со счётчиками пар (pairs, pruned, compared)
+        :return: пары (ключ пары, (совпадение токенов, похожесть, (код 1, код 2)))
+        """
+        for i, j in pairs:
+            (name1, fp1), (name2, fp2) = fingerprints[i], fingerprints[j]
+            stats["pairs"] += 1
+            if min_similarity > 0 and not CopydetectProcessor._similarity_bound(fp1, fp2, file_stats[i], file_stats[j], min_similarity):
+                stats["pruned"] += 1
+                continue
+
+            stats["compared"] += 1
+            token_overlap, similarities, slices = copydetect.compare_files(fp1, fp2)
+            if token_overlap == 0:
+                # общих фрагментов нет, copydetect в этом случае возвращает пустые slices, подсвечивать нечего
+                yield f"{prefix}___{name1}___{name2}", (0, 0.0, (fp1.raw_code, fp2.raw_code))
+                continue
+            code1, _ = copydetect.utils.highlight_overlap(fp1.raw_code, slices[0], "~~SFH~~", "~~SFH~~")
+            code2, _ = copydetect.utils.highlight_overlap(fp2.raw_code, slices[1], "~~SFH~~", "~~SFH~~")
+            yield f"{prefix}___{name1}___{name2}", (int(token_overlap), float(sum(similarities) / len(similarities)), (code1, code2))
+
+    @staticmethod
+    def iter_pairs(data: tuple[dict, bool], cache: dict | None = None, min_similarity: float = 0.0, stats: dict | None = None,
+                   max_df: float | None = None, boilerplate: set | None = None) -> Iterator[tuple[str, tuple]]:
         """
         :param data: указывается словарь/список с данными о решениях учеников (заполняется автоматом, см. BaseArchiveProcessor)
-        :return возвращает словарь как результат обработки copydetect'а, где ключи - разделённые имена файлов, а значения - значения совпадения токенов, похожесть, а также сами коды с отмеченными частями предположительно сплагиаченного кода
+        :param cache: общий словарь отпечатков для нескольких архивов (см. _fingerprint), по умолчанию отпечатки строятся заново
+        :param min_similarity: пары, которые заведомо похожи меньше, чем на это значение, не сравниваются и не попадают в результат (по умолчанию сравниваются все)
+        :param stats: если передан словарь, то в него записывается число всех пар, отсечённых (pruned) и реально сравнённых (compared), а также число выкинутых общих хэшей (dropped_hashes)
+        :param max_df: если задано, то хэши, встречающиеся в большей доле решений группы, считаются общим кодом и не участвуют в сравнении
+        :param boilerplate: хэши загруженного шаблонного кода, которые не участвуют в сравнении (см. boilerplate_hashes)
+        :return генератор результатов copydetect'а, где ключи - разделённые имена файлов, а значения - значения совпадения токенов, похожесть, а также сами коды с отмеченными частями предположительно сплагиаченного кода
         """
-        report = {}
+        if stats is None:
+            stats = {}
+        stats.update(pairs=0, pruned=0, compared=0, dropped_hashes=0)
 
-        if data[1]:
-            data = data[0]
-            for letter in data:
-                for extension in data[letter]:
-                    fingerprints = [(Path(file).name, copydetect.CodeFingerprint(file, 25, 1)) for file in data[letter][extension]]
-                    for (name1, fp1), (name2, fp2) in combinations(fingerprints, 2):
-                        token_overlap, similarities, slices = copydetect.compare_files(fp1, fp2)
-                        code1, _ = copydetect.utils.highlight_overlap(fp1.raw_code, slices[0], "~~SFH~~", "~~SFH~~")
-                        code2, _ = copydetect.utils.highlight_overlap(fp2.raw_code, slices[1], "~~SFH~~", "~~SFH~~")
-                        report[f"{letter}___{extension}___{name1}___{name2}"] = (token_overlap, sum(similarities) / len(similarities), (code1, code2))
-            if not report:
-                raise ValueError(f"возникла неожиданная ошибка: {report}")
-        else:
-            data = data[0]
-            for extension in data:
-                fingerprints = [(Path(file).name, copydetect.CodeFingerprint(file, 25, 1)) for file in data[extension]]
-                for (name1, fp1), (name2, fp2) in combinations(fingerprints, 2):
-                    token_overlap, similarities, slices = copydetect.compare_files(fp1, fp2)
-                    code1, _ = copydetect.utils.highlight_overlap(fp1.raw_code, slices[0], "~~SFH~~", "~~SFH~~")
-                    code2, _ = copydetect.utils.highlight_overlap(fp2.raw_code, slices[1], "~~SFH~~", "~~SFH~~")
-                    report[f"A___{extension}___{name1}___{name2}"] = (token_overlap, sum(similarities) / len(similarities), (code1, code2))
-            if not report:
-                raise ValueError(f"возникла неожиданная ошибка: {report}")
-        return report
+        for prefix, files in CopydetectProcessor.groups(data):
+            fingerprints, file_stats, dropped = CopydetectProcessor.prepare_group(files, cache, max_df, boilerplate, bounds=min_similarity > 0)
+            stats["dropped_hashes"] += dropped
+            yield from CopydetectProcessor.compare_pairs(prefix, fingerprints, file_stats, combinations(range(len(files)), 2), min_similarity, stats)
+
+        if not stats["pairs"]:
+            raise ValueError("возникла неожиданная ошибка: в архиве нет ни одной пары файлов для сравнения")
 
 
 class VectorProcessor(BaseArchiveProcessor):
@@ -238,55 +549,217 @@ class VectorProcessor(BaseArchiveProcessor):
     """
 
     @staticmethod
-    def analyze_files(data: tuple[dict, bool]) -> dict | set[tuple]:
+    def _document(file: str, cache: dict | None = None) -> str:
+        """
+        читает и нормализует файл, а если передан общий кэш, то переиспользует уже прочитанный файл с таким же содержимым
+        :param file: путь до файла с кодом
+        :param cache: общий словарь документов (хэш содержимого -> текст), см. пакетную обработку в upload.py
+        :return: нормализованный код файла
+        """
+        if cache is None:
+            return VectorProcessor._read_file(file)
+        key = ("vector", VectorProcessor._content_key(file))
+        if key not in cache:
+            cache[key] = VectorProcessor._read_file(file)
+        return cache[key]
+
+    @staticmethod
+    def prepare_group(files: list[str], cache: dict | None = None) -> tuple[list[str], np.ndarray]:
+        """
+        читает файлы одной задачи с одним расширением и строит их TF-IDF векторы
+        :param files: пути до файлов группы
+        :param cache: общий словарь документов (см. _document)
+        :return: имена файлов и TF-IDF матрица (строка - файл)
+        """
+        filenames = [Path(fp).name for fp in files]
+        docs = [VectorProcessor._document(fp, cache) for fp in files]
+        return filenames, TfidfVectorizer().fit_transform(docs).toarray()
+
+    @staticmethod
+    def compare_pairs(prefix: str, prepared: tuple[list[str], np.ndarray], pairs) -> Iterator[tuple[str, float]]:
+        """
+        генератор: сравнивает указанные пары файлов группы и отдаёт результаты по одному
+        :param prefix: начало ключа пары ("буква задачи___расширение")
+        :param prepared: имена файлов и TF-IDF матрица группы (см. prepare_group)
+        :param pairs: итерируемое пар индексов файлов (i, j), i < j
+        :return: пары (ключ пары, "похожесть" пары файлов)
+        """
+        filenames, tfidf_matrix = prepared
+        for file_a, file_b, similarity in VectorProcessor._find_plagiarism(filenames, tfidf_matrix, pairs):
+            yield f"{prefix}___{file_a}___{file_b}", similarity
+
+    @staticmethod
+    def iter_pairs(data: tuple[dict, bool], cache: dict | None = None) -> Iterator[tuple[str, float]]:
         """
         :param data: указывается словарь/список с данными о решениях учеников (заполняется автоматом, см. BaseArchiveProcessor)
-        :return: возвращает множество кортежей со значениями "похожести" пар указанных файлов
+        :param cache: общий словарь документов для нескольких архивов (см. _document), по умолчанию файлы читаются заново
+        :return: генератор пар (ключ пары, "похожесть" пары файлов)
         """
-        result = {}
+        for prefix, files in VectorProcessor.groups(data):
+            if not files:
+                continue
 
-        if data[1]:
-            data = data[0]
-            for letter, extensions in data.items():
-                for ext, files in extensions.items():
-                    filenames = [Path(fp).name for fp in files]
-                    docs = [VectorProcessor._read_file(fp) for fp in files]
+            prepared = VectorProcessor.prepare_group(files, cache)
+            yield from VectorProcessor.compare_pairs(prefix, prepared, combinations(range(len(files)), 2))
 
-                    if not docs:
-                        continue
+    @staticmethod
+    def _find_plagiarism(filenames: list[str], vectors: np.ndarray, pairs) -> Iterator[tuple]:
+        """
+        генератор: рассчитывает косинусное сходство векторов каждой пары файлов
+        :param filenames: имена файлов
+        :param vectors: векторизованные тексты кода файлов (в том же порядке)
+        :param pairs: пары индексов файлов (i, j)
+        :return: кортежи, первые два элемента которых - имена файлов (по алфавиту), третий - косинусное сходство
+        """
+        for i, j in pairs:
+            similarity = cosine_similarity([vectors[i]], [vectors[j]])[0][0]
+            sorted_files = sorted((filenames[i], filenames[j]))
 
-                    tfidf_matrix = TfidfVectorizer().fit_transform(docs).toarray()
+            yield sorted_files[0], sorted_files[1], float(similarity)
 
-                    doc_pairs = list(zip(filenames, tfidf_matrix))
-                    r = list(VectorProcessor._find_plagiarism(doc_pairs))
-                    for file in r:
-                        result[f"{letter}___{ext}___{file[0]}___{file[1]}"] = file[2]
-        else:
-            data = data[0]
-            for extension in data:
-                docs = [VectorProcessor._read_file(file) for file in data[extension]]
-                transformed_docs = TfidfVectorizer().fit_transform(docs).toarray()
-                doc_pairs = list(zip([Path(path).name for path in data[extension]], transformed_docs))
-                r = list(VectorProcessor._find_plagiarism(doc_pairs))
-                for file in r:
-                    result[f"A___{extension}___{file[0]}___{file[1]}"] = file[2]
 
-        return result
+class AstProcessor(BaseArchiveProcessor):
+    """
+    процессор, сравнивающий структуру решений на python по их синтаксическим деревьям.
+    каждый файл один раз разбирается модулем ast, и снизу вверх считаются хэши всех его поддеревьев, в которых имена переменных, функций и атрибутов
+    и значения констант не учитываются, а операторы внутри блоков (тело функции, цикла, if и т.п.) сортируются.
+    поэтому переименование переменных и перестановка операторов похожесть не меняют (в отличие от TF-IDF и токенов copydetect'а).
+    общие поддеревья всех пар находятся за один проход по индексу хэш поддерева -> файлы, без попарного сравнения файлов;
+    похожесть пары - коэффициент Дайса по множествам хэшей поддеревьев: 2 * |общие| / (|хэши 1| + |хэши 2|)
+    решения на остальных языках обрабатываются процессором FALLBACK
+    """
+    MIN_SUBTREE_SIZE = 5  # поддеревья меньше этого числа узлов (x = 1, f(x)) есть почти в каждом решении и не учитываются
+    UNORDERED_FIELDS = {"body", "orelse", "finalbody", "handlers"}  # списки операторов, порядок которых не учитывается
+    FALLBACK = VectorProcessor
+
+    @staticmethod
+    def _subtree_hashes(tree: ast.AST) -> set[int]:
+        """
+        считает нормализованные хэши всех поддеревьев снизу вверх: хэш узла строится из его типа и хэшей детей, так что каждое поддерево обходится один раз
+        :param tree: синтаксическое дерево файла
+        :return: множество хэшей поддеревьев не меньше MIN_SUBTREE_SIZE узлов
+        """
+        hashes = set()
+
+        def visit(node: ast.AST) -> tuple[int, int]:
+            size = 1
+            parts = [type(node).__name__]
+            for field, value in ast.iter_fields(node):
+                if isinstance(value, list):
+                    children = []
+                    for item in value:
+                        if isinstance(item, ast.AST):
+                            child_hash, child_size = visit(item)
+                            children.append(child_hash)
+                            size += child_size
+                    if field in AstProcessor.UNORDERED_FIELDS:
+                        children.sort()
+                    parts.append((field, tuple(children)))
+                elif isinstance(value, ast.AST):
+                    child_hash, child_size = visit(value)
+                    parts.append((field, child_hash))
+                    size += child_size
+                elif isinstance(node, ast.Constant) and field == "value":
+                    parts.append((field, type(value).__name__))  # от константы остаётся только её тип
+                elif not isinstance(value, str):
+                    parts.append((field, value))  # is_async, level и т.п.; строки - это имена, они отбрасываются
+            node_hash = hash(tuple(parts))
+            if size >= AstProcessor.MIN_SUBTREE_SIZE:
+                hashes.add(node_hash)
+            return node_hash, size
+
+        visit(tree)
+        return hashes
+
+    @staticmethod
+    def _tree(file: str, cache: dict | None = None) -> set[int]:
+        """
+        разбирает файл и считает хэши его поддеревьев, а если передан общий кэш, то переиспользует хэши файла с таким же содержимым
+        :param file: путь до файла с кодом
+        :param cache: общий словарь хэшей (хэш содержимого -> хэши поддеревьев), см. пакетную обработку в upload.py
+        :return: множество хэшей поддеревьев (пустое, если файл не разбирается как python)
+        """
+        key = ("ast", AstProcessor._content_key(file))
+        if cache is not None and key in cache:
+            return cache[key]
+
+        with open(file, "rb") as f:
+            source = f.read().decode("utf-8", errors="replace")
+        try:
+            hashes = AstProcessor._subtree_hashes(ast.parse(source))
+        except (SyntaxError, ValueError, RecursionError):
+            hashes = set()  # решение с синтаксической ошибкой ни с чем структурно не совпадает
 
+        if cache is not None:
+            cache[key] = hashes
+        return hashes
 
     @staticmethod
-    def _find_plagiarism(pairs: list[tuple]) -> set[tuple]:
+    def _split_python(data: tuple[dict, bool]) -> tuple[tuple[dict, bool], tuple[dict, bool]]:
         """
-        рассчитывает косинусное сходство векторов каждого файла и записывает их во множество
-        :param pairs: принимает пары для каждого файла в формате списка, первым элементом является - имя файла, а вторым - векторизованный текст кода файла
-        :return: возвращает результаты сравнения в формате множества кортежей, первый элемент которых - имя файла, второй - косинусное сходство
+        :param data: словарь с данными о решениях учеников и признак архива из контеста (см. common_extraction)
+        :return: те же данные только с решениями на python и только с остальными решениями
         """
-        results = set()
+        if data[1]:
+            python = {letter: {ext: files for ext, files in extensions.items() if ext == "py"} for letter, extensions in data[0].items()}
+            other = {letter: {ext: files for ext, files in extensions.items() if ext != "py"} for letter, extensions in data[0].items()}
+        else:
+            python = {ext: files for ext, files in data[0].items() if ext == "py"}
+            other = {ext: files for ext, files in data[0].items() if ext != "py"}
+        return (python, data[1]), (other, data[1])
 
-        for (file_a, vec_a), (file_b, vec_b) in combinations(pairs, 2):
-            similarity = cosine_similarity([vec_a], [vec_b])[0][0]
-            sorted_files = sorted((file_a, file_b))
+    @staticmethod
+    def prepare_group(files: list[str], cache: dict | None = None, max_df: float | None = None) -> tuple[list[str], np.ndarray]:
+        """
+        считает для файлов одной группы на python, сколько поддеревьев общие у каждой пары, за один проход по индексу хэш поддерева -> файлы
+        :param files: пути до файлов группы
+        :param cache: общий словарь хэшей (см. _tree)
+        :param max_df: если задано, то поддеревья, встречающиеся в большей доле решений группы, не учитываются
+        :return: имена файлов и матрица shared: shared[i, j] - число общих поддеревьев файлов i и j, на диагонали - число поддеревьев файла
+        """
+        filenames = [Path(fp).name for fp in files]
+        trees = [AstProcessor._tree(fp, cache) for fp in files]
+
+        # индекс хэш поддерева -> файлы в виде разреженной матрицы файлы x поддеревья
+        index = {}
+        rows, columns = [], []
+        for i, hashes in enumerate(trees):
+            for subtree in hashes:
+                rows.append(i)
+                columns.append(index.setdefault(subtree, len(index)))
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(files), len(index)))
+        if max_df is not None and len(files) >= 3:
+            incidence = incidence[:, np.flatnonzero(incidence.getnnz(axis=0) <= max_df * len(files))]
+
+        return filenames, (incidence @ incidence.T).toarray()
+
+    @staticmethod
+    def compare_pairs(prefix: str, prepared: tuple[list[str], np.ndarray], pairs) -> Iterator[tuple[str, float]]:
+        """
+        генератор: отдаёт похожесть указанных пар файлов группы по одной
+        :param prefix: начало ключа пары ("буква задачи___расширение")
+        :param prepared: имена файлов и матрица общих поддеревьев группы (см. prepare_group)
+        :param pairs: итерируемое пар индексов файлов (i, j), i < j
+        :return: пары (ключ пары, структурная похожесть пары файлов)
+        """
+        filenames, shared = prepared
+        for i, j in pairs:
+            total = shared[i, i] + shared[j, j]
+            similarity = 2 * shared[i, j] / total if total else 0.0
+            yield f"{prefix}___{filenames[i]}___{filenames[j]}", float(similarity)
+
+    @staticmethod
+    def iter_pairs(data: tuple[dict, bool], cache: dict | None = None, max_df: float | None = None) -> Iterator[tuple[str, float]]:
+        """
+        :param data: указывается словарь/список с данными о решениях учеников (заполняется автоматом, см. BaseArchiveProcessor)
+        :param cache: общий словарь хэшей и документов для нескольких архивов (см. _tree), по умолчанию файлы разбираются заново
+        :param max_df: если задано, то поддеревья, встречающиеся в большей доле решений группы, считаются общим кодом и не учитываются
+        :return: генератор пар (ключ пары, структурная похожесть пары файлов); для решений не на python - результаты FALLBACK
+        """
+        python, other = AstProcessor._split_python(data)
 
-            results.add((sorted_files[0], sorted_files[1], similarity))
+        for prefix, files in AstProcessor.groups(python):
+            prepared = AstProcessor.prepare_group(files, cache, max_df)
+            yield from AstProcessor.compare_pairs(prefix, prepared, combinations(range(len(files)), 2))
 
-        return results
+        yield from AstProcessor.FALLBACK.iter_pairs(other, cache=cache)
@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import Schema, fields, validate, ValidationError
 from flask import current_app
 
 def validate_archive(file):
@@ -21,6 +21,26 @@ class ArchiveUploadSchema(Schema):
         validate=validate_archive,
         metadata={"description": "загрузить архив в формате '.zip', '.rar', '.tar.gz', '.tgz' с кодом "}
     )
+    boilerplate = fields.List(
+        fields.Raw(type="file"),
+        load_default=list,
+        metadata={"description": "необязательные файлы с шаблонным кодом (стартовый код, шаблоны ввода/вывода), совпадения по которому не считаются плагиатом"}
+    )
+
+class BatchUploadSchema(Schema):
+    """
+    нужен для стандартизации структуры апи; проверяет, переданы ли архивы для пакетной обработки (несколько архивов или один архив с архивами)
+    """
+    files = fields.List(
+        fields.Raw(type="file", validate=validate_archive),
+        required=True,
+        metadata={"description": "загрузить несколько архивов или один архив из архивов в формате '.zip', '.rar', '.tar.gz', '.tgz'"}
+    )
+    boilerplate = fields.List(
+        fields.Raw(type="file"),
+        load_default=list,
+        metadata={"description": "необязательные файлы с шаблонным кодом (стартовый код, шаблоны ввода/вывода), совпадения по которому не считаются плагиатом"}
+    )
 
 class ArchiveResponseSchema(Schema):
     """
@@ -32,9 +52,45 @@ class ArchiveResponseSchema(Schema):
     results = fields.Dict(description="результат обработки", required=False)
     archive_name = fields.String(required=True, description="название данного архива")
     created_at = fields.DateTime(require=True, description="время загрузки архива")
+    children = fields.List(fields.String(), description="id task'ов архивов пакета (только для пакетной обработки)", required=False)
+    progress = fields.String(description="сколько архивов пакета уже обработано (только для пакетной обработки)", required=False)
+    estimate = fields.Dict(description="оценка времени и памяти обработки до её начала (см. EstimateResponseSchema)", required=False)
 
 class ProcessArgsSchema(Schema):
     """
     нужен для стандартизации структуры апи; получает метод обработки из запроса пользователя
     """
-    process_type = fields.String(required=True, description="какой метод обработки использовать")
\ No newline at end of file
+    process_type = fields.String(required=True, description="какой метод обработки использовать")
+    min_similarity = fields.Float(
+        load_default=0.0,
+        validate=validate.Range(min=0.0, max=1.0),
+        description="пары, похожесть которых заведомо ниже этого значения, не сравниваются copydetect'ом и не попадают в результат"
+    )
+    max_df = fields.Float(
+        load_default=None,
+        validate=validate.Range(min=0.0, max=1.0, min_inclusive=False),
+        description="хэши кода, встречающиеся в большей доле решений задачи, считаются общим кодом и не сравниваются copydetect'ом"
+    )
+
+class CacheStatsSchema(Schema):
+    """
+    нужен для стандартизации структуры ответов апи; определяет, какие счётчики кэша ответов возвращаются клиенту
+    """
+    hits = fields.Integer(required=True, description="число ответов, отданных из кэша")
+    misses = fields.Integer(required=True, description="число запросов, которых не было в кэше")
+    entries = fields.Integer(required=True, description="число закэшированных task'ов")
+    current_bytes = fields.Integer(required=True, description="текущий размер кэша в байтах")
+    max_bytes = fields.Integer(required=True, description="максимальный размер кэша в байтах")
+
+class EstimateResponseSchema(Schema):
+    """
+    нужен для стандартизации структуры ответов апи; определяет, какая оценка обработки архива возвращается клиенту до её начала
+    """
+    files = fields.Integer(required=True, description="число файлов с кодом в архиве")
+    bytes = fields.Integer(required=True, description="суммарный размер файлов с кодом в байтах")
+    pairs = fields.Integer(required=True, description="число пар файлов, которые будут сравниваться")
+    seconds = fields.Float(required=True, description="оценка времени обработки в секундах")
+    memory_bytes = fields.Integer(required=True, description="оценка пиковой памяти обработки в байтах")
+    methods = fields.Dict(required=True, description="та же оценка для каждого метода отдельно (samples - по скольким прошлым task'ам подобрана модель, 0 - модель по умолчанию)")
+    accepted = fields.Boolean(required=True, description="примет ли /archives/ этот архив с текущими лимитами")
+    reason = fields.String(description="почему архив не будет принят", required=False)
@@ -0,0 +1,476 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import time
+import uuid
+from itertools import combinations, product
+from tempfile import TemporaryDirectory
+from typing import Iterator
+from processors import CopydetectProcessor
+
+
+"""
+разбиение пар группы на тайлы для copydetect'а.
+пространство пар n×n группы (одна задача + одно расширение) режется на квадраты tile_size×tile_size (берутся только тайлы на диагонали и над ней),
+тайлы лежат в общей очереди (sqlite-файл), откуда их забирают воркеры - сам апи и, при желании, процессы `python tiles.py --db ...` на других машинах.
+рядом с очередью (в папке tiles_archives) лежат копии архивов, так что воркеру нужен только доступ к папке с очередью.
+результат каждого тайла сразу записывается в очередь, поэтому после падения процесса task продолжается с последнего готового тайла.
+каждая job помечается владельцем (экземпляром апи, который её поставил), и после перезапуска апи продолжает только свои job'ы.
+тайл, на котором воркеры падают MAX_FAILURES раз подряд, помечается failed и больше никому не выдаётся
+"""
+
+logger = logging.getLogger(__name__)
+
+ARCHIVES_DIR = "tiles_archives"  # папка с копиями архивов рядом с файлом очереди
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    archive_path TEXT NOT NULL,
+    params TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    tile_size INTEGER NOT NULL,
+    dropped INTEGER,
+    owner TEXT,
+    PRIMARY KEY (task_id, grp)
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    task_id TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    result TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (task_id, grp, row, col)
+);
+CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status, task_id);
+"""
+
+
+def tile_pairs(size: int, tile_size: int, row: int, col: int):
+    """
+    :param size: число файлов в группе
+    :param tile_size: сторона тайла
+    :param row: номер тайла по строкам
+    :param col: номер тайла по столбцам (col >= row)
+    :return: пары индексов файлов (i, j), i < j, попадающие в тайл
+    """
+    rows = range(row * tile_size, min(size, (row + 1) * tile_size))
+    if row == col:
+        return combinations(rows, 2)
+    return product(rows, range(col * tile_size, min(size, (col + 1) * tile_size)))
+
+
+class TileCoordinator:
+    """
+    очередь тайлов и хранилище их результатов (чекпоинтов) поверх sqlite.
+    каждый вызов открывает своё соединение, поэтому объект можно использовать из разных потоков, а сам файл - из разных процессов.
+    файл должен лежать на диске, доступном всем воркерам. для нескольких машин это общая папка, файловая система которой корректно поддерживает блокировки файлов
+    (журнал в режиме WAL поверх сетевых файловых систем не работает, поэтому используется обычный журнал sqlite)
+    """
+    def __init__(self, path: str = "tiles.db", lease: float = 600, owner: str | None = None, max_failures: int = 3):
+        """
+        :param path: путь до sqlite-файла очереди
+        :param lease: через сколько секунд взятый, но не сданный тайл считается брошенным и выдаётся другому воркеру
+        :param owner: имя экземпляра апи, которым помечаются его job'ы (по умолчанию имя машины)
+        :param max_failures: после скольких падений воркеров тайл помечается failed
+        """
+        self.path = path
+        self.lease = lease
+        self.owner = owner or socket.gethostname()
+        self.max_failures = max_failures
+        self.tile_size = 64
+        self._ready = False
+
+    def init_app(self, app):
+        """
+        берёт настройки из конфига фласка (TILES_DB, TILE_SIZE, TILE_LEASE, TILES_OWNER, TILE_MAX_FAILURES), по аналогии с db.init_app
+        :param app: объект instance'а flask'а
+        """
+        self.path = app.config.get("TILES_DB", self.path)
+        self.tile_size = app.config.get("TILE_SIZE", self.tile_size)
+        self.lease = app.config.get("TILE_LEASE", self.lease)
+        self.owner = app.config.get("TILES_OWNER") or self.owner
+        self.max_failures = app.config.get("TILE_MAX_FAILURES", self.max_failures)
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._ready:
+            conn.executescript(SCHEMA)
+            self._ready = True
+        return conn
+
+    def _resolve(self, archive_path: str) -> str:
+        """
+        :param archive_path: путь до архива из очереди (относительно папки с очередью, см. share_archive)
+        :return: путь до архива на этой машине
+        """
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), archive_path)
+
+    def share_archive(self, task_id: str, archive_path: str) -> str:
+        """
+        копирует архив task'а в папку рядом с очередью, чтобы его могли распаковать воркеры на других машинах
+        (исходный архив лежит во временной папке машины с апи). повторный вызов архив не копирует
+        :param task_id: id task'а
+        :param archive_path: путь до архива на машине с апи
+        :return: путь до копии относительно папки с очередью (его и нужно передавать в plan)
+        """
+        relative = os.path.join(ARCHIVES_DIR, task_id, os.path.basename(archive_path))
+        target = self._resolve(relative)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(archive_path, target + ".part")
+            os.replace(target + ".part", target)  # воркер не должен увидеть недокопированный архив
+        return relative
+
+    def plan(self, task_id: str, group: str, size: int, archive_path: str, params: dict, tile_size: int | None = None):
+        """
+        ставит тайлы группы в очередь. повторный вызов для того же task'а ничего не меняет, поэтому им же продолжается прерванный task
+        :param task_id: id task'а
+        :param group: "буква задачи___расширение"
+        :param size: число файлов в группе
+        :param archive_path: путь до копии архива относительно папки с очередью (см. share_archive), по нему воркеры сами распаковывают файлы
+        :param params: параметры процессора (min_similarity, max_df, boilerplate, process_type)
+        :param tile_size: сторона тайла, по умолчанию TILE_SIZE из конфига
+        """
+        tile_size = tile_size or self.tile_size
+        count = -(-size // tile_size)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO jobs (task_id, grp, archive_path, params, size, tile_size, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, group, archive_path, json.dumps(params), size, tile_size, self.owner)
+            ).rowcount
+            if inserted:
+                conn.executemany(
+                    "INSERT INTO tiles (task_id, grp, row, col) VALUES (?, ?, ?, ?)",
+                    [(task_id, group, row, col) for row in range(count) for col in range(row, count)]
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def claim(self, worker: str, task_id: str | None = None) -> dict | None:
+        """
+        забирает один свободный (или брошенный) тайл. брошенный тайл значит, что взявший его воркер пропал, и это считается его падением
+        :param worker: id воркера
+        :param task_id: если указан, то берутся только тайлы этого task'а
+        :return: описание тайла или None, если свободных тайлов нет
+        """
+        expired = time.time() - self.lease
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE tiles SET status = 'failed', failures = failures + 1, error = COALESCE(error, 'воркер пропал, не сдав тайл') "
+                "WHERE status = 'claimed' AND claimed_at < ? AND failures + 1 >= ?",
+                (expired, self.max_failures)
+            )
+            query = (
+                "SELECT t.task_id, t.grp, t.row, t.col, t.status, j.archive_path, j.params, j.size, j.tile_size "
+                "FROM tiles t JOIN jobs j ON j.task_id = t.task_id AND j.grp = t.grp "
+                "WHERE (t.status = 'pending' OR (t.status = 'claimed' AND t.claimed_at < ?))"
+            )
+            args = [expired]
+            if task_id is not None:
+                query += " AND t.task_id = ?"
+                args.append(task_id)
+            row = conn.execute(query + " LIMIT 1", args).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE tiles SET status = 'claimed', worker = ?, claimed_at = ?, failures = failures + ? "
+                "WHERE task_id = ? AND grp = ? AND row = ? AND col = ?",
+                (worker, time.time(), int(row[4] == "claimed"), row[0], row[1], row[2], row[3])
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        task_id, group, tile_row, tile_col, _, archive_path, params, size, tile_size = row
+        return {
+            "task_id": task_id, "group": group, "row": tile_row, "col": tile_col,
+            "archive_path": self._resolve(archive_path), "params": json.loads(params), "size": size, "tile_size": tile_size
+        }
+
+    def complete(self, tile: dict, report: dict, stats: dict):
+        """
+        сохраняет результат тайла (чекпоинт)
+        :param tile: описание тайла из claim
+        :param report: результаты пар тайла
+        :param stats: счётчики пар тайла (pairs, pruned, compared)
+        """
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE tiles SET status = 'done', result = ? WHERE task_id = ? AND grp = ? AND row = ? AND col = ?",
+                (json.dumps({"report": report, "stats": stats}), tile["task_id"], tile["group"], tile["row"], tile["col"])
+            )
+        finally:
+            conn.close()
+
+    def release(self, tile: dict, error: str):
+        """
+        возвращает тайл в очередь, если воркер не смог его посчитать, а после max_failures неудач помечает его failed
+        :param tile: описание тайла из claim
+        :param error: текст ошибки воркера
+        """
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE tiles SET status = CASE WHEN failures + 1 >= ? THEN 'failed' ELSE 'pending' END, "
+                "failures = failures + 1, error = ?, worker = NULL, claimed_at = NULL "
+                "WHERE task_id = ? AND grp = ? AND row = ? AND col = ?",
+                (self.max_failures, error, tile["task_id"], tile["group"], tile["row"], tile["col"])
+            )
+        finally:
+            conn.close()
+
+    def set_dropped(self, task_id: str, group: str, dropped: int):
+        """
+        запоминает, сколько общих хэшей выкинуто в группе (считается один раз, тем воркером, который первым подготовил группу)
+        """
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE jobs SET dropped = ? WHERE task_id = ? AND grp = ? AND dropped IS NULL", (dropped, task_id, group))
+        finally:
+            conn.close()
+
+    def remaining(self, task_id: str) -> int:
+        """
+        :return: сколько тайлов task'а ещё ждут воркеров или считаются (failed тайлы сюда не входят)
+        """
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM tiles WHERE task_id = ? AND status IN ('pending', 'claimed')", (task_id,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def failure(self, task_id: str) -> str | None:
+        """
+        :return: ошибка одного из тайлов task'а, помеченных failed, или None, если таких нет
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT grp, row, col, error FROM tiles WHERE task_id = ? AND status = 'failed' LIMIT 1", (task_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        group, tile_row, tile_col, error = row
+        return f"тайл ({tile_row}, {tile_col}) группы {group} не посчитан после {self.max_failures} попыток: {error}"
+
+    def iter_results(self, task_id: str, stats: dict) -> Iterator[tuple[str, list]]:
+        """
+        генератор: отдаёт результаты пар из чекпоинтов task'а по одному тайлу за раз
+        :param task_id: id task'а
+        :param stats: словарь, в который складываются суммарные счётчики (pairs, pruned, compared, dropped_hashes)
+        :return: пары (ключ пары, результат сравнения)
+        """
+        stats.update(pairs=0, pruned=0, compared=0, dropped_hashes=0)
+        conn = self._connect()
+        try:
+            stats["dropped_hashes"] = conn.execute("SELECT COALESCE(SUM(dropped), 0) FROM jobs WHERE task_id = ?", (task_id,)).fetchone()[0]
+            for (result,) in conn.execute("SELECT result FROM tiles WHERE task_id = ? AND status = 'done' ORDER BY grp, row, col", (task_id,)):
+                result = json.loads(result)
+                for key, value in result["stats"].items():
+                    stats[key] += value
+                yield from result["report"].items()
+        finally:
+            conn.close()
+
+    def forget(self, task_id: str):
+        """
+        удаляет тайлы, чекпоинты и копию архива task'а (после того как результат сохранён в базу данных апи)
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM tiles WHERE task_id = ?", (task_id,))
+            conn.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        shutil.rmtree(self._resolve(os.path.join(ARCHIVES_DIR, task_id)), ignore_errors=True)
+
+    def unfinished(self) -> list[tuple[str, str, dict]]:
+        """
+        :return: task'и этого экземпляра апи (owner), у которых в очереди остались тайлы или несобранные чекпоинты: (id task'а, путь до копии архива, параметры).
+        job'ы других экземпляров апи, работающих с той же очередью, сюда не попадают
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT task_id, MIN(archive_path), MIN(params) FROM jobs WHERE owner = ? GROUP BY task_id", (self.owner,)).fetchall()
+        finally:
+            conn.close()
+        return [(task_id, self._resolve(archive_path), json.loads(params)) for task_id, archive_path, params in rows]
+
+
+class TileWorker:
+    """
+    считает тайлы из очереди. распакованный архив и подготовленные группы (отпечатки) держатся только для последнего task'а,
+    так что соседние тайлы одной группы не пересчитывают отпечатки
+    """
+    def __init__(self, coordinator: TileCoordinator, worker_id: str | None = None):
+        """
+        :param coordinator: очередь тайлов
+        :param worker_id: id воркера, по умолчанию имя машины + pid
+        """
+        self.coordinator = coordinator
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._task_id = None
+        self._extract_dir = None
+        self._groups = {}
+        self._prepared = {}
+        self._boilerplate = None
+
+    def attach(self, task_id: str, groups: dict):
+        """
+        позволяет отдать воркеру уже распакованные файлы task'а, чтобы не распаковывать архив второй раз (так делает сам апи)
+        :param task_id: id task'а
+        :param groups: словарь "буква задачи___расширение" -> пути до файлов группы
+        """
+        self.close()
+        self._task_id = task_id
+        self._groups = groups
+
+    def _load(self, tile: dict):
+        if self._task_id == tile["task_id"]:
+            return
+        self.close()
+        self._extract_dir = TemporaryDirectory()
+        data = CopydetectProcessor.common_extraction(tile["archive_path"], self._extract_dir.name)
+        self._task_id = tile["task_id"]
+        self._groups = dict(CopydetectProcessor.groups(data))
+
+    def run_once(self, task_id: str | None = None) -> bool:
+        """
+        забирает и считает один тайл. если посчитать не удалось, то тайл возвращается в очередь с увеличенным счётчиком падений, а исключение пробрасывается
+        :param task_id: если указан, то берутся только тайлы этого task'а
+        :return: False, если свободных тайлов нет
+        """
+        tile = self.coordinator.claim(self.worker_id, task_id)
+        if tile is None:
+            return False
+        try:
+            self._load(tile)
+            params = tile["params"]
+            group = tile["group"]
+            if group not in self._prepared:
+                if self._boilerplate is None:
+                    # в params лежат коды шаблонных файлов: хэши copydetect'а зависят от процесса (hash() питона), поэтому строятся здесь
+                    self._boilerplate = CopydetectProcessor.boilerplate_hashes(params.get("boilerplate") or [])
+                fingerprints, file_stats, dropped = CopydetectProcessor.prepare_group(
+                    self._groups[group], max_df=params.get("max_df"), boilerplate=self._boilerplate,
+                    bounds=params.get("min_similarity", 0.0) > 0
+                )
+                self._prepared[group] = (fingerprints, file_stats)
+                self.coordinator.set_dropped(tile["task_id"], group, dropped)
+            fingerprints, file_stats = self._prepared[group]
+
+            stats = {"pairs": 0, "pruned": 0, "compared": 0}
+            report = dict(CopydetectProcessor.compare_pairs(
+                group, fingerprints, file_stats,
+                tile_pairs(tile["size"], tile["tile_size"], tile["row"], tile["col"]),
+                params.get("min_similarity", 0.0), stats
+            ))
+        except Exception as e:
+            self.coordinator.release(tile, f"{type(e).__name__}: {e}")
+            self.close()  # распакованный архив мог остаться в непонятном состоянии
+            raise
+        self.coordinator.complete(tile, report, stats)
+        return True
+
+    def close(self):
+        """
+        удаляет распакованный архив и подготовленные группы
+        """
+        if self._extract_dir is not None:
+            self._extract_dir.cleanup()
+        self._extract_dir = None
+        self._task_id = None
+        self._groups = {}
+        self._prepared = {}
+        self._boilerplate = None
+
+
+def iter_tiled(coordinator: TileCoordinator, archive_path: str, task_id: str, params: dict, stats: dict, poll_interval: float = 1.0) -> Iterator[tuple[str, list]]:
+    """
+    генератор: считает copydetect по архиву через очередь тайлов: ставит тайлы всех групп в очередь (или продолжает уже поставленные),
+    сам считает тайлы, пока они есть, ждёт тайлы, взятые другими воркерами, и затем отдаёт результаты пар из чекпоинтов
+    :param coordinator: очередь тайлов
+    :param archive_path: путь до архива (копируется рядом с очередью для других воркеров, см. TileCoordinator.share_archive)
+    :param task_id: id task'а
+    :param params: параметры процессора (min_similarity, max_df, boilerplate, process_type)
+    :param stats: словарь, в который записываются счётчики пар (см. TileCoordinator.iter_results)
+    :param poll_interval: как часто проверять тайлы других воркеров
+    :return: пары (ключ пары, результат сравнения), как у CopydetectProcessor.iter_pairs
+    """
+    worker = TileWorker(coordinator)
+    shared_path = coordinator.share_archive(task_id, archive_path)
+    with TemporaryDirectory() as extract_dir:
+        groups = CopydetectProcessor.groups(CopydetectProcessor.common_extraction(archive_path, extract_dir))
+        for group, files in groups:
+            coordinator.plan(task_id, group, len(files), shared_path, params)
+        try:
+            while True:
+                if worker._task_id != task_id:
+                    worker.attach(task_id, dict(groups))  # после ошибки воркер сбрасывает файлы, отдаём их снова
+                try:
+                    if worker.run_once(task_id):
+                        continue
+                except Exception as e:
+                    logger.error(f"ошибка тайла task'а {task_id}: {e}")  # тайл вернулся в очередь, число попыток ограничено
+                    continue
+                if not coordinator.remaining(task_id):
+                    break
+                time.sleep(poll_interval)  # оставшиеся тайлы считают другие воркеры
+        finally:
+            worker.close()
+
+    error = coordinator.failure(task_id)
+    if error is not None:
+        raise ValueError(error)
+    yield from coordinator.iter_results(task_id, stats)
+    if not stats["pairs"]:
+        raise ValueError("возникла неожиданная ошибка: в архиве нет ни одной пары файлов для сравнения")
+
+
+if __name__ == "__main__":
+    # воркер для других машин: python tiles.py --db /shared/tiles.db
+    parser = argparse.ArgumentParser(description="воркер, считающий тайлы пар copydetect'а из общей очереди")
+    parser.add_argument("--db", default="tiles.db", help="путь до sqlite-файла очереди (общий для всех воркеров)")
+    parser.add_argument("--lease", type=float, default=600, help="через сколько секунд взятый тайл считается брошенным")
+    parser.add_argument("--poll", type=float, default=5, help="пауза между проверками пустой очереди")
+    parser.add_argument("--max-failures", type=int, default=3, help="после скольких падений тайл больше не выдаётся (должно совпадать с TILE_MAX_FAILURES апи)")
+    parser.add_argument("--once", action="store_true", help="выйти, когда очередь опустеет")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tile_worker = TileWorker(TileCoordinator(cli_args.db, cli_args.lease, max_failures=cli_args.max_failures))
+    try:
+        while True:
+            try:
+                if tile_worker.run_once():
+                    continue
+            except Exception as e:
+                # тайл уже вернулся в очередь со счётчиком падений, воркер берёт следующий
+                logger.error(f"не удалось посчитать тайл: {type(e).__name__}: {e}")
+                continue
+            if cli_args.once:
+                break
+            time.sleep(cli_args.poll)
+    finally:
+        tile_worker.close()
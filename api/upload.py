@@ -1,17 +1,26 @@
 import json
+import hashlib
+import itertools
 import logging
+import shutil
 import tempfile
+import time
 from flask_smorest import Blueprint, abort
 from werkzeug.utils import secure_filename
 import os
 from application import limiter
-from extensions import db
-from processors import CopydetectProcessor, VectorProcessor
-from flask import current_app
-from schemas import ArchiveUploadSchema, ArchiveResponseSchema, ProcessArgsSchema
+from extensions import db, result_cache, tile_coordinator
+from cache import LRUDict
+from processors import BaseArchiveProcessor, CopydetectProcessor, VectorProcessor, AstProcessor
+from flask import current_app, Response, stream_with_context
+from schemas import ArchiveUploadSchema, BatchUploadSchema, ArchiveResponseSchema, ProcessArgsSchema, CacheStatsSchema, EstimateResponseSchema
 from concurrent.futures import ThreadPoolExecutor
 import uuid
-from models import Task
+from datetime import datetime, timedelta
+from models import Task, PairResult, TaskTiming
+from tiles import iter_tiled
+from estimate import estimate, check_limits, record_timing
+from sqlalchemy import insert, select, literal
 
 
 # сетапим логгер
@@ -32,21 +41,6 @@ blp = Blueprint(
     description="проверка архивов с кодом на плагиат"
 )
 
-def convert_sets(obj):
-    """
-    нужна для того, чтобы избавиться от TypeError: Object of type set is not JSON serializable, т.к. некоторые процессоры возвращают множества (превращает множества в списки)
-    :param obj: объект для перевода
-    :return: переведённый объект
-    """
-    if isinstance(obj, set):
-        return list(obj)
-    elif isinstance(obj, dict):
-        return {k: convert_sets(v) for k, v in obj.items()}
-    elif isinstance(obj, (list, tuple)):
-        return [convert_sets(x) for x in obj]
-    return obj
-
-
 
 @blp.route("/archives/", methods=["POST"])  # api/archives/
 @blp.arguments(ProcessArgsSchema, location="query")  # archives/?process_type=...
@@ -57,11 +51,17 @@ def process_archive(query_args, args):
     """
     функция принимает архив, проверяет, валидное ли у него название, имеет ли он верное расширение, потом сохраняет его в папку в %temp% и выполняет на нём process_archive_background, по endpoint'у возвращает начало работы над архивом
     функция также записывает в базу данных task и ставит его на обработку
-    :param query_args: какой метод при обработке использовать: copydetect, vector (нужные пишутся через пробел маленькими буквами)
-    :param args: сам архив в bytes
-    :return: 202 response о том, что началась обработка архива
+    если такой же архив с теми же параметрами уже обрабатывался (см. content_key), то сразу возвращается ответ check_status по готовому task'у
+    :param query_args: какой метод при обработке использовать: copydetect, vector, ast (нужные пишутся через пробел маленькими буквами) + параметры процессоров (min_similarity, max_df)
+    :param args: сам архив в bytes (+ необязательные файлы с шаблонным кодом)
+    :return: 202 response о том, что началась обработка архива (или 200 response с готовыми результатами)
     """
     process_type: str = query_args["process_type"]
+    options = {
+        "min_similarity": query_args["min_similarity"],
+        "max_df": query_args["max_df"],
+        "boilerplate": read_boilerplate(args["boilerplate"])
+    }
 
     if 'file' not in args:
         abort(400, message="архив не загружен")
@@ -79,8 +79,17 @@ def process_archive(query_args, args):
     filepath = os.path.join(tempdir, filename)
     file.save(filepath)
 
+    key = content_key(filepath, process_type, options)
+    done = find_completed_task(key)
+    if done is not None:
+        # тот же архив с теми же параметрами уже обработан: отдаём готовый результат сразу, ничего не пересчитывая
+        shutil.rmtree(tempdir, ignore_errors=True)
+        return status_response(done.id)
+
+    cost = preflight([filepath], process_type, tempdir)
+
     task_id = str(uuid.uuid4())
-    new_task = Task(id=task_id, status="processing", archive_name=filename)
+    new_task = Task(id=task_id, status="processing", archive_name=filename, content_key=key)
     app = current_app._get_current_object()
 
     with app.app_context():
@@ -93,7 +102,8 @@ def process_archive(query_args, args):
         app,
         filepath,
         task_id,
-        process_type
+        process_type,
+        options
     )
 
     return {
@@ -101,27 +111,402 @@ def process_archive(query_args, args):
         "status": "processing",
         "message": "обработка архива началась",
         "archive_name": filename,
+        "estimate": cost,
+    }, 202
+
+
+@blp.route("/archives/batch/", methods=["POST"])  # api/archives/batch/
+@blp.arguments(ProcessArgsSchema, location="query")  # archives/batch/?process_type=...
+@blp.arguments(BatchUploadSchema, location="files")  # endpoint принимает несколько архивов (или один архив из архивов) в формате по схеме в schemas.py
+@blp.response(202, ArchiveResponseSchema)  # endpoint возвращает в формате по схеме в schemas.py
+@limiter.limit("4 per minute")  # весь пакет считается одним реквестом
+def process_batch(query_args, args):
+    """
+    функция принимает сразу несколько архивов (например, все контесты за семестр) или один архив, состоящий из архивов,
+    создаёт пакетный task и по task'у на каждый архив и ставит их на обработку одной задачей (см. process_batch_background)
+    :param query_args: какой метод при обработке использовать: copydetect, vector, ast (нужные пишутся через пробел маленькими буквами) + параметры процессоров (min_similarity, max_df)
+    :param args: сами архивы в bytes (+ необязательные файлы с шаблонным кодом)
+    :return: 202 response о том, что началась обработка пакета, с id task'ов каждого архива
+    """
+    process_type: str = query_args["process_type"]
+    options = {
+        "min_similarity": query_args["min_similarity"],
+        "max_df": query_args["max_df"],
+        "boilerplate": read_boilerplate(args["boilerplate"])
+    }
+    files = args["files"]
+
+    if not files:
+        abort(400, message="архивы не загружены")
+    if len(files) > current_app.config["MAX_BATCH_ARCHIVES"]:
+        abort(400, message=f"в пакете может быть не больше {current_app.config['MAX_BATCH_ARCHIVES']} архивов")
+
+    tempdir = tempfile.mkdtemp()
+    filepaths = []
+    for index, file in enumerate(files):
+        filename = secure_filename(file.filename)
+        if not filename or not any(filename.lower().endswith(ext) for ext in current_app.config['ALLOWED_EXTENSIONS']):
+            shutil.rmtree(tempdir, ignore_errors=True)
+            abort(400, message=f"неверный формат архива {file.filename!r}")
+        os.makedirs(os.path.join(tempdir, str(index)))
+        filepath = os.path.join(tempdir, str(index), filename)
+        file.save(filepath)
+        filepaths.append(filepath)
+
+    batch_name = f"пакет из {len(filepaths)} архивов"
+    if len(filepaths) == 1:
+        try:
+            nested = BaseArchiveProcessor.extract_nested_archives(
+                filepaths[0], os.path.join(tempdir, "nested"), current_app.config['ALLOWED_EXTENSIONS'], current_app.config["MAX_BATCH_ARCHIVES"]
+            )
+        except ValueError as e:
+            shutil.rmtree(tempdir, ignore_errors=True)
+            abort(400, message=str(e))
+        if nested:
+            batch_name = os.path.basename(filepaths[0])
+            filepaths = nested
+    cost = preflight(filepaths, process_type, tempdir)
+
+    parent_id = str(uuid.uuid4())
+    archives = [(str(uuid.uuid4()), filepath) for filepath in filepaths]
+    app = current_app._get_current_object()
+
+    with app.app_context():
+        db.session.add(Task(id=parent_id, status="processing", archive_name=batch_name[:100]))
+        for task_id, filepath in archives:
+            db.session.add(Task(
+                id=task_id,
+                status="processing",
+                archive_name=os.path.basename(filepath),
+                parent_id=parent_id,
+                content_key=content_key(filepath, process_type, options)
+            ))
+        db.session.commit()
+
+    executor.submit(
+        process_batch_background,
+        app,
+        tempdir,
+        archives,
+        parent_id,
+        process_type,
+        options
+    )
+
+    return {
+        "task_id": parent_id,
+        "status": "processing",
+        "message": "обработка пакета архивов началась",
+        "archive_name": batch_name,
+        "children": [task_id for task_id, _ in archives],
+        "progress": f"0/{len(archives)}",
+        "estimate": cost,
     }, 202
 
 
-def process_archive_background(app, filepath, task_id, methods="copydetect vector"):
+@blp.route("/archives/estimate/", methods=["POST"])  # api/archives/estimate/
+@blp.arguments(ProcessArgsSchema, location="query")  # archives/estimate/?process_type=...
+@blp.arguments(ArchiveUploadSchema, location="files")  # endpoint принимает тот же архив, что и /archives/
+@blp.response(200, EstimateResponseSchema)  # endpoint возвращает в формате по схеме в schemas.py
+@limiter.limit("10 per minute")
+def estimate_archive(query_args, args):
+    """
+    пробный запуск: читает только оглавление архива и возвращает оценку времени и памяти обработки (см. estimate.py), ничего не ставя на обработку
+    :param query_args: какой метод при обработке использовать: copydetect, vector, ast (нужные пишутся через пробел маленькими буквами)
+    :param args: сам архив в bytes
+    :return: оценка обработки и то, примет ли её /archives/ с текущими лимитами
+    """
+    file = args["file"]
+    filename = secure_filename(file.filename)
+    if not filename:
+        abort(400, message="пустое имя архива")
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, filename)
+        file.save(filepath)
+        methods = parse_methods(query_args["process_type"])
+        try:
+            result = estimate([BaseArchiveProcessor.manifest(filepath)], methods)
+        except ValueError as e:
+            abort(400, message=str(e))
+
+    reason = check_limits(result)
+    result["accepted"] = reason is None
+    if reason is not None:
+        result["reason"] = reason
+    return result
+
+
+def parse_methods(process_type):
+    """
+    :param process_type: методы обработки через пробел
+    :return: список выбранных методов
+    """
+    methods = [method for method in process_type.split() if method in ("copydetect", "vector", "ast")]
+    if not methods:
+        abort(400, message="вы выбрали неверный метод обработки архива (выбирайте из 'vector copydetect ast')")
+    return methods
+
+
+def preflight(filepaths, process_type, tempdir):
+    """
+    оценивает стоимость обработки сохранённых архивов до постановки task'а (см. estimate.py) и отклоняет task'и, не укладывающиеся в лимиты
+    :param filepaths: пути до архивов
+    :param process_type: методы обработки через пробел
+    :param tempdir: папка с архивами, которая удаляется при отказе
+    :return: оценка обработки для ответа пользователю
+    """
+    try:
+        methods = parse_methods(process_type)
+        result = estimate([BaseArchiveProcessor.manifest(filepath) for filepath in filepaths], methods)
+    except ValueError as e:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        abort(400, message=str(e))
+    except Exception:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        raise
+
+    reason = check_limits(result)
+    if reason is not None:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        abort(413, message=reason)
+    return result
+
+
+def content_key(filepath, process_type, options):
+    """
+    ключ результата по содержимому: хэш байтов архива вместе с методами и параметрами процессоров.
+    у одинаковых выгрузок контеста (загруженных повторно со страницы, скриптом или после удаления архива) ключ совпадает независимо от имени файла
+    :param filepath: путь до сохранённого архива
+    :param process_type: методы обработки через пробел
+    :param options: параметры процессоров из запроса пользователя (см. run_processors)
+    :return: sha256 в hex
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    params = {
+        "process_type": sorted(set(process_type.split())),
+        "min_similarity": options.get("min_similarity", 0.0),
+        "max_df": options.get("max_df"),
+        # шаблонный код учитывается по содержимому файлов (и расширению, по нему copydetect выбирает лексер), а не по хэшам copydetect'а:
+        # те строятся через hash() питона и после перезапуска апи были бы другими
+        "boilerplate": sorted(
+            [os.path.splitext(name)[1], hashlib.sha256(code.encode("utf-8")).hexdigest()] for name, code in options.get("boilerplate") or ()
+        )
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def find_completed_task(key):
+    """
+    :param key: ключ результата (см. content_key)
+    :return: последний успешно завершённый task с таким ключом не старше RESULT_CACHE_DAYS или None
+    """
+    if key is None:
+        return None
+    query = Task.query.filter_by(content_key=key, status="completed")
+    max_age = current_app.config["RESULT_CACHE_DAYS"]
+    if max_age is not None:
+        query = query.filter(Task.created_at >= datetime.now() - timedelta(days=max_age))
+    return query.order_by(Task.created_at.desc()).first()
+
+
+def copy_results(source, task):
+    """
+    копирует результаты уже обработанного архива в task пакета средствами базы данных (insert ... select), не пересчитывая и не читая пары в память
+    :param source: завершённый task с тем же ключом результата
+    :param task: task архива из пакета
+    """
+    db.session.execute(
+        insert(PairResult).from_select(
+            ["task_id", "method", "pair", "value"],
+            select(literal(task.id), PairResult.method, PairResult.pair, PairResult.value)
+            .where(PairResult.task_id == source.id)
+            .order_by(PairResult.id)
+        )
+    )
+    task.status = "completed"
+    task.results = source.results
+
+
+def purge_expired(app):
+    """
+    удаляет task'и старше RESULT_RETENTION_DAYS и самые старые сверх RESULT_RETENTION_MAX_TASKS вместе с их парами, чтобы база данных не росла бесконечно
+    (по умолчанию оба лимита выключены и ничего не удаляется; пакет удаляется целиком вместе с архивами; task'и в обработке не трогаются). вызывается после обработки каждого task'а и при запуске апи
+    :param app: объект текущего instance'а flask'а
+    """
+    with app.app_context():
+        retention = current_app.config["RESULT_RETENTION_DAYS"]
+        max_tasks = current_app.config["RESULT_RETENTION_MAX_TASKS"]
+        finished = Task.query.filter(Task.parent_id.is_(None), Task.status != "processing")
+
+        expired = []
+        if retention is not None:
+            expired += [task.id for task in finished.filter(Task.created_at < datetime.now() - timedelta(days=retention))]
+        if max_tasks is not None:
+            expired += [task.id for task in finished.order_by(Task.created_at.desc()).offset(max_tasks)]
+        if not expired:
+            return
+
+        expired = list(set(expired))
+        expired += [task.id for task in Task.query.filter(Task.parent_id.in_(expired))]
+        PairResult.query.filter(PairResult.task_id.in_(expired)).delete(synchronize_session=False)
+        TaskTiming.query.filter(TaskTiming.task_id.in_(expired)).update({TaskTiming.task_id: None}, synchronize_session=False)  # замеры нужны модели стоимости и после удаления task'а
+        for task in Task.query.filter(Task.id.in_(expired)):
+            db.session.delete(task)  # по одному, чтобы сработал сброс кэша ответов (см. models.py)
+        db.session.commit()
+        current_app.logger.info(f"удалено устаревших task'ов: {len(expired)}")
+
+
+def read_boilerplate(files):
+    """
+    читает загруженные шаблонные файлы сразу в запросе, т.к. после ответа объекты файлов уже закрыты.
+    хранятся сами коды, а не хэши: хэши copydetect'а строятся через hash() питона, который в каждом процессе свой,
+    поэтому они считаются там, где нужны (см. run_processors и TileWorker в tiles.py)
+    :param files: список загруженных файлов (поле boilerplate)
+    :return: список пар (имя файла, код файла)
+    """
+    sources = [(secure_filename(file.filename) or "boilerplate.txt", file.read().decode("utf-8", errors="replace")) for file in files]
+    try:
+        CopydetectProcessor.boilerplate_hashes(sources)  # чтобы ошибка разбора вернулась пользователю, а не уронила task
+    except Exception as e:
+        abort(400, message=f"не удалось разобрать шаблонный код: {e}")
+    return sources
+
+
+def store_pairs(task_id, method, pairs):
+    """
+    пишет результаты пар в базу данных пачками по RESULTS_BATCH_SIZE по мере того, как процессор их отдаёт, так что в памяти никогда не лежит весь отчёт
+    :param task_id: id task'а
+    :param method: метод обработки
+    :param pairs: итерируемое пар (ключ пары, результат сравнения), см. iter_pairs процессоров
+    """
+    batch_size = current_app.config["RESULTS_BATCH_SIZE"]
+    batch = []
+    for pair, value in pairs:
+        batch.append({"task_id": task_id, "method": method, "pair": pair, "value": value})
+        if len(batch) >= batch_size:
+            db.session.execute(insert(PairResult), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(insert(PairResult), batch)
+        db.session.commit()
+
+
+def run_processors(filepath, methods, task_id, options=None, cache=None, tiled=False):
+    """
+    прогоняет архив через выбранные процессоры и сохраняет результаты пар в базу данных (см. store_pairs)
+    :param filepath: путь до архива
+    :param methods: список методов обработки
+    :param task_id: id task'а, к которому привязываются результаты пар
+    :param options: параметры процессоров из запроса пользователя (min_similarity, max_df и шаблонный код для copydetect, см. read_boilerplate)
+    :param cache: общий кэш отпечатков/документов для архивов одного пакета (см. process_batch_background)
+    :param tiled: если True (и TILE_SIZE в конфиге не 0), то пары copydetect'а считаются тайлами через очередь с чекпоинтами (см. tiles.py)
+    :return: словарь для Task.results: всё, кроме самих пар (методы, пары которых лежат в PairResult, перечислены в stored_pairs)
+    """
+    options = options or {}
+    PairResult.query.filter_by(task_id=task_id).delete()  # остатки прошлой попытки, если task продолжается после падения
+    db.session.commit()
+    # у продолженных task'ов часть тайлов уже посчитана, их время испортило бы модель стоимости
+    manifest = None if options.get("resumed") else BaseArchiveProcessor.manifest(filepath)
+
+    results = {"copydetect": None, "vector": None, "stored_pairs": []}
+    if "vector" in methods:
+        started = time.perf_counter()
+        store_pairs(task_id, "vector", VectorProcessor.iter_path(filepath, cache=cache))
+        results["stored_pairs"].append("vector")
+        if manifest is not None:
+            record_timing(task_id, "vector", manifest, time.perf_counter() - started)
+    if "ast" in methods:
+        # структурное сравнение решений на python, остальные языки - через VectorProcessor (см. AstProcessor)
+        results["ast"] = None
+        started = time.perf_counter()
+        store_pairs(task_id, "ast", AstProcessor.iter_path(filepath, cache=cache, max_df=options.get("max_df")))
+        results["stored_pairs"].append("ast")
+        if manifest is not None:
+            record_timing(task_id, "ast", manifest, time.perf_counter() - started)
+    if "copydetect" in methods:
+        stats = {}
+        started = time.perf_counter()
+        if tiled and current_app.config["TILE_SIZE"]:
+            params = {
+                "process_type": " ".join(methods),
+                "min_similarity": options.get("min_similarity", 0.0),
+                "max_df": options.get("max_df"),
+                "boilerplate": options.get("boilerplate") or []
+            }
+            pairs = iter_tiled(tile_coordinator, filepath, task_id, params, stats)
+        else:
+            pairs = CopydetectProcessor.iter_path(
+                filepath,
+                cache=cache,
+                min_similarity=options.get("min_similarity", 0.0),
+                stats=stats,
+                max_df=options.get("max_df"),
+                boilerplate=CopydetectProcessor.boilerplate_hashes(options.get("boilerplate") or [])
+            )
+        store_pairs(task_id, "copydetect", pairs)
+        results["stored_pairs"].append("copydetect")
+        if manifest is not None:
+            record_timing(task_id, "copydetect", manifest, time.perf_counter() - started)
+        results["copydetect_stats"] = stats  # сколько пар было всего, сколько отсечено по оценке сверху, сколько реально сравнено и сколько общих хэшей выкинуто
+    return results
+
+
+def resume_unfinished(app):
+    """
+    продолжает task'и, обработка которых оборвалась вместе с процессом апи: их тайлы и чекпоинты остались в очереди (см. tiles.py),
+    поэтому заново считаются только недосчитанные тайлы. берутся только job'ы этого экземпляра апи (TILES_OWNER), job'ы других экземпляров не трогаются
+    :param app: объект текущего instance'а flask'а
+    """
+    with app.app_context():
+        for task_id, filepath, params in tile_coordinator.unfinished():
+            task = db.session.get(Task, task_id)
+            if task is None:
+                # база данных могла быть пересоздана или TILES_OWNER совпал с другим экземпляром - job не удаляем, чужую работу не ломаем
+                current_app.logger.warning(f"в очереди тайлов есть job task'а {task_id}, которого нет в базе данных, пропускаем")
+                continue
+            if task.status != "processing":
+                tile_coordinator.forget(task_id)  # task уже закончен, остались только его чекпоинты
+                continue
+            if not os.path.exists(filepath):
+                current_app.logger.error(f"копия архива task'а {task_id} пропала, продолжить нельзя")
+                task.status = "failed"
+                task.results = json.dumps({"error": "архив task'а пропал из очереди тайлов"}, indent=4)
+                db.session.commit()
+                tile_coordinator.forget(task_id)
+                continue
+            current_app.logger.info(f"продолжаем обработку task'а {task_id}")
+            executor.submit(
+                process_archive_background,
+                app,
+                filepath,
+                task_id,
+                params["process_type"],
+                dict(params, resumed=True)
+            )
+
+
+def process_archive_background(app, filepath, task_id, methods="copydetect vector", options=None):
     """
     запускает проверку на плагиат для файлов архива и заполняет task в базе данных с нужным id
     :param app: объект текущего instance'а flask'а
     :param filepath: путь до архива
     :param task_id: случайно генерируемый id (см. _process_archive)
     :param methods: позволяет выбрать метод обработки архива
+    :param options: параметры процессоров из запроса пользователя (см. run_processors)
     """
     methods = methods.split()
-    if "copydetect" not in methods and "vector" not in methods:
-        abort(400, message="вы выбрали неверный метод обработки архива (выбирайте из 'vector copydetect')")
+    if "copydetect" not in methods and "vector" not in methods and "ast" not in methods:
+        abort(400, message="вы выбрали неверный метод обработки архива (выбирайте из 'vector copydetect ast')")
     with app.app_context():
         try:
             db.session.remove()
-            results = {
-                "copydetect": convert_sets(CopydetectProcessor.process_archive(filepath)) if "copydetect" in methods else None,
-                "vector": convert_sets(VectorProcessor.process_archive(filepath)) if "vector" in methods else None
-            }
+            results = run_processors(filepath, methods, task_id, options, tiled=True)
 
             task = db.session.query(Task).get(task_id)
             task.status = "completed"
@@ -130,17 +515,128 @@ def process_archive_background(app, filepath, task_id, methods="copydetect vecto
 
         except Exception as e:
             current_app.logger.error(f"ошибка обработки: {str(e)}")
+            db.session.rollback()
+            PairResult.query.filter_by(task_id=task_id).delete()
             task = Task.query.get(task_id)
             task.status = "failed"
             task.results = json.dumps({"error": str(e)}, indent=4)
             db.session.commit()
 
         finally:
-            try:
-                os.remove(filepath)
-                os.rmdir(os.path.dirname(filepath))
-            except Exception as cleanup_error:
-                current_app.logger.error(f"не удалось очистить папки: {cleanup_error}")
+            tile_coordinator.forget(task_id)
+            # у продолженного task'а filepath - копия архива в очереди тайлов, её уже удалил forget
+            if not (options or {}).get("resumed"):
+                try:
+                    os.remove(filepath)
+                    os.rmdir(os.path.dirname(filepath))
+                except Exception as cleanup_error:
+                    current_app.logger.error(f"не удалось очистить папки: {cleanup_error}")
+    purge_expired(app)
+
+
+def process_batch_background(app, tempdir, archives, parent_id, methods="copydetect vector", options=None):
+    """
+    обрабатывает все архивы пакета одной задачей: отпечатки и прочитанные файлы хранятся в общем кэше по хэшу содержимого (не больше BATCH_CACHE_MAX_BYTES),
+    поэтому одинаковые файлы из разных контестов обрабатываются один раз
+    :param app: объект текущего instance'а flask'а
+    :param tempdir: папка с архивами пакета (удаляется после обработки)
+    :param archives: список пар (id task'а архива, путь до архива)
+    :param parent_id: id пакетного task'а
+    :param methods: позволяет выбрать метод обработки архивов
+    :param options: параметры процессоров из запроса пользователя (см. run_processors)
+    """
+    methods = methods.split()
+    cache = LRUDict(app.config["BATCH_CACHE_MAX_BYTES"])
+    with app.app_context():
+        db.session.remove()
+        try:
+            for task_id, filepath in archives:
+                task = db.session.get(Task, task_id)
+                try:
+                    done = find_completed_task(task.content_key)
+                    if done is not None:
+                        copy_results(done, task)
+                    else:
+                        results = run_processors(filepath, methods, task_id, options, cache=cache)
+                        task.status = "completed"
+                        task.results = json.dumps(results, indent=4, default=str)
+                except Exception as e:
+                    current_app.logger.error(f"ошибка обработки архива {task.archive_name} из пакета {parent_id}: {str(e)}")
+                    db.session.rollback()
+                    PairResult.query.filter_by(task_id=task_id).delete()
+                    task = db.session.get(Task, task_id)
+                    task.status = "failed"
+                    task.results = json.dumps({"error": str(e)}, indent=4)
+                db.session.commit()
+
+        except Exception as e:
+            current_app.logger.error(f"ошибка обработки пакета {parent_id}: {str(e)}")
+
+        finally:
+            # пакет завершается в любом случае, а архивы, до которых дело не дошло, помечаются упавшими, чтобы не висеть в processing
+            db.session.rollback()
+            Task.query.filter_by(parent_id=parent_id, status="processing").update(
+                {"status": "failed", "results": json.dumps({"error": "обработка пакета прервана"}, indent=4)}
+            )
+            parent = db.session.get(Task, parent_id)
+            parent.status = "completed"
+            db.session.commit()
+            shutil.rmtree(tempdir, ignore_errors=True)
+    purge_expired(app)
+
+
+def iter_results_json(task):
+    """
+    генератор: отдаёт json с результатами task'а кусками. пары читаются из базы данных пачками по RESULTS_BATCH_SIZE и сразу уходят в ответ,
+    так что ни весь отчёт, ни вся строка json никогда не лежат в памяти целиком
+    :param task: объект task'а
+    :return: куски json (вместе образуют значение поля results)
+    """
+    children = Task.query.filter_by(parent_id=task.id).order_by(Task.archive_name).all()
+    if children:
+        # пакетный task: результаты всех архивов пакета в одном ответе
+        yield "{"
+        for index, child in enumerate(children):
+            yield (", " if index else "") + f'{json.dumps(child.id)}: {{"archive_name": {json.dumps(child.archive_name)}, "status": {json.dumps(child.status)}, "results": '
+            yield from iter_results_json(child)
+            yield "}"
+        yield "}"
+        return
+
+    if not task.results:
+        yield "null"
+        return
+
+    results = json.loads(task.results)
+    stored_pairs = results.pop("stored_pairs", [])  # у старых task'ов все пары лежат прямо в Task.results
+    batch_size = current_app.config["RESULTS_BATCH_SIZE"]
+    yield "{"
+    for index, (key, value) in enumerate(results.items()):
+        yield (", " if index else "") + f"{json.dumps(key)}: "
+        if key not in stored_pairs:
+            yield json.dumps(value, default=str)
+            continue
+
+        rows = (
+            db.session.query(PairResult.pair, PairResult.value)
+            .filter_by(task_id=task.id, method=key)
+            .order_by(PairResult.id)
+            .yield_per(batch_size)
+        )
+        separator = "{"
+        chunk = []
+        for pair, pair_value in rows:
+            chunk.append(f"{json.dumps(pair)}: {json.dumps(pair_value)}")
+            if len(chunk) >= batch_size:
+                yield separator + ", ".join(chunk)
+                separator = ", "
+                chunk = []
+        if chunk:
+            yield separator + ", ".join(chunk)
+        elif separator == "{":
+            yield "{"
+        yield "}"
+    yield "}"
 
 
 @limiter.limit("1 per second")
@@ -152,12 +648,59 @@ def check_status(task_id):
     :param task_id: полученный ранее id
     :return: словарь с задачей, её id, статусом и данными обработки
     """
+    return status_response(task_id)
+
+
+def status_response(task_id):
+    """
+    собирает ответ check_status. он отдаётся потоком (см. iter_results_json), а ответы по завершённым task'ам больше не меняются, поэтому они кэшируются уже сериализованными (см. cache.py)
+    и повторные запросы не трогают ни базу данных, ни json
+    :param task_id: id task'а
+    :return: response с задачей, её id, статусом и данными обработки
+    """
+    body = result_cache.get(task_id)
+    if body is not None:
+        return Response(body, mimetype="application/json")
+
+    generation = result_cache.generation()  # до чтения task'а, см. ResultCache.put
     task = Task.query.get(task_id)
-    return {
-        "task": task,
+    if task is None:
+        abort(404, message="task с таким id не найден")
+
+    response = {
         "task_id": task.id,
         "status": task.status,
-        "results": json.loads(task.results) if task.results else None,
         "archive_name": task.archive_name,
         "created_at": task.created_at
-    }
\ No newline at end of file
+    }
+    children = Task.query.filter_by(parent_id=task.id).all()
+    if children:
+        response["children"] = sorted(child.id for child in children)
+        response["progress"] = f"{sum(child.status != 'processing' for child in children)}/{len(children)}"
+    header = json.dumps(ArchiveResponseSchema().dump(response))
+
+    def generate():
+        cached = [] if task.status == "completed" else None
+        size = 0
+        for chunk in itertools.chain([header[:-1] + ', "results": '], iter_results_json(task), ["}"]):
+            data = chunk.encode("utf-8")
+            if cached is not None:
+                cached.append(data)
+                size += len(data)
+                if size > result_cache.max_bytes:
+                    cached = None  # в кэш всё равно не влезет
+            yield data
+        if cached is not None:
+            result_cache.put(task_id, b"".join(cached), generation)
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@blp.route("/cache/", methods=["GET"])  # api/cache/
+@blp.response(200, CacheStatsSchema)  # endpoint возвращает в формате по схеме в schemas.py
+def cache_stats():
+    """
+    функция нужна для просмотра счётчиков кэша ответов check_status
+    :return: словарь с числом попаданий, промахов и заполненностью кэша
+    """
+    return result_cache.stats()
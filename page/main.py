@@ -1,13 +1,12 @@
 import os
-import uuid
 import requests
 from flask import Flask, render_template, url_for, flash, redirect, jsonify, request, current_app
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, login_user, login_required, current_user, logout_user
 from requests import RequestException
-import pathlib
-import tempfile
+from requests.adapters import HTTPAdapter
 from forms import RegistrationForm, LoginForm
+from streaming import ArchiveStream
 from models import User, Archive
 from extensions import db
 from dotenv import load_dotenv
@@ -22,6 +21,7 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+app.config['API_URL'] = os.getenv('API_URL', 'http://localhost:8000')
 app.config.update(
     SESSION_COOKIE_SECURE=True,
     SESSION_COOKIE_HTTPONLY=True,
@@ -33,6 +33,11 @@ db.init_app(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# одна сессия на весь процесс: соединения с апи переиспользуются (keep-alive) вместо нового tcp-соединения на каждый запрос
+api_session = requests.Session()
+api_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+api_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -100,52 +105,41 @@ def logout():
 @app.route('/upload', methods=['POST'])
 @login_required
 def handle_upload():
-    if 'archive' not in request.files:
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
         return jsonify(error='загруженного архива нет'), 400
 
-    file = request.files['archive']
-    true_filename = file.filename
-
-    if file.filename == '':
-        return jsonify(error='пустое имя архива'), 400
-
     current_count = Archive.query.filter_by(user_id=current_user.id).count()
     if current_count >= 10:
         return jsonify({'error': f'Достигнут лимит по числу архивов для пользователя {current_user.id}'}), 400
 
-    suffix = pathlib.Path(file.filename).suffix
-    name = f'{true_filename}{str(uuid.uuid4())}'
-
-    file_bytes = file.read()
-
-    with tempfile.TemporaryDirectory() as upload_dir:
-
-        save_path = os.path.join(upload_dir, f"{name}{suffix}")
-
-        with open(save_path, "wb") as f:
-            f.write(file_bytes)
-
-        try:
-            with open(save_path, "rb") as fp:
-                resp = requests.post(
-                    "http://localhost:8000/api/archives/",
-                    files={"file": fp},
-                    params={"process_type": "vector copydetect"},
-                )
-
-            resp.raise_for_status()
-            task_id = resp.json()["task_id"]
-        except RequestException as e:
-            return jsonify(error=f'ошибка коммуникации с апи: {e}'), 502
-        except KeyError:
-            return jsonify(error='неверный response от апи'), 502
+    # request.files не трогаем: иначе werkzeug сам вычитает весь архив в память/временный файл
+    upload = ArchiveStream(request.stream, request.mimetype_params['boundary'])
+    try:
+        if not upload.open():
+            return jsonify(error='загруженного архива нет или у него пустое имя'), 400
+
+        resp = api_session.post(
+            f"{app.config['API_URL']}/api/archives/",
+            data=upload,
+            headers={"Content-Type": upload.content_type},
+            params={"process_type": "vector copydetect"},
+        )
 
-        while True:
-            status_resp = requests.get(f"http://localhost:8000/api/status/{task_id}")
-            status_resp.raise_for_status()
-            status_data = status_resp.json()
-            if status_data.get("status") == "completed":
-                break
+        resp.raise_for_status()
+        task_id = resp.json()["task_id"]
+    except RequestException as e:
+        return jsonify(error=f'ошибка коммуникации с апи: {e}'), 502
+    except ValueError as e:
+        return jsonify(error=f'не удалось прочитать архив: {e}'), 400
+    except KeyError:
+        return jsonify(error='неверный response от апи'), 502
+
+    while True:
+        status_resp = api_session.get(f"{app.config['API_URL']}/api/status/{task_id}")
+        status_resp.raise_for_status()
+        status_data = status_resp.json()
+        if status_data.get("status") == "completed":
+            break
 
     with current_app.app_context():
         new_arch = Archive(
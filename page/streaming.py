@@ -0,0 +1,79 @@
+import uuid
+from werkzeug.http import dump_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
+
+
+CHUNK_SIZE = 64 * 1024  # сколько байт за раз читаем из входящего запроса
+
+
+class ArchiveStream:
+    """
+    пробрасывает файл из входящего multipart-запроса в новый multipart-запрос к апи, не складывая его ни в память целиком, ни во временную папку.
+    входящее тело читается кусками по CHUNK_SIZE прямо из request.stream, разбирается sansio-парсером werkzeug'а
+    и сразу же отдаётся кусками в requests (итератор => chunked transfer encoding)
+    """
+    def __init__(self, stream, boundary: str, field: str = "archive", target_field: str = "file"):
+        """
+        :param stream: request.stream входящего запроса
+        :param boundary: boundary входящего multipart-запроса (request.mimetype_params["boundary"])
+        :param field: имя поля с архивом во входящем запросе
+        :param target_field: имя поля, под которым архив уйдёт в апи
+        """
+        self.stream = stream
+        self.field = field
+        self.target_field = target_field
+        self.filename = None
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._decoder = MultipartDecoder(boundary.encode("latin-1"))
+        self._eof = False
+        self._iter = None
+
+    def _events(self):
+        """
+        генератор событий парсера, подгружающий входящее тело по мере надобности
+        """
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                if self._eof:
+                    raise ValueError("тело запроса оборвалось")
+                chunk = self.stream.read(CHUNK_SIZE)
+                self._eof = not chunk
+                self._decoder.receive_data(chunk or None)
+                continue
+            yield event
+            if isinstance(event, Epilogue):
+                return
+
+    def open(self) -> bool:
+        """
+        дочитывает входящий запрос до начала части с архивом (остальные поля пропускаются)
+        :return: True если архив найден и у него есть имя
+        """
+        self._iter = self._events()
+        for event in self._iter:
+            if isinstance(event, File) and event.name == self.field:
+                self.filename = event.filename
+                return bool(self.filename)
+        return False
+
+    def __iter__(self):
+        """
+        отдаёт тело multipart-запроса к апи: заголовок части, сам архив кусками, закрывающий boundary
+        """
+        disposition = dump_options_header("form-data", {"name": self.target_field, "filename": self.filename})
+        yield (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: {disposition}\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+
+        for event in self._iter:
+            if isinstance(event, Data):
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    break
+
+        yield f"\r\n--{self.boundary}--\r\n".encode("utf-8")